@@ -2,9 +2,11 @@ from twist import *
 from hooks.sqlite import Sqlite
 from postgres import Postgres
 from auth import Auth
+from session import MemorySessionStore, SqliteSessionStore
 
 __all__ = [
-	'App', 'View', 'locate_view', 'Sqlite', 'Postgres', 'Auth'
+	'App', 'View', 'locate_view', 'Sqlite', 'Postgres', 'Auth',
+	'MemorySessionStore', 'SqliteSessionStore', 'Json', 'Tasks'
 ]
 
 __author__ = 'Vinhthuy Phan'
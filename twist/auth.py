@@ -1,12 +1,136 @@
+'''
+bcrypt hashing runs on a pool of worker processes, off the request thread:
+	Auth.rounds = 12			# cost factor; older hashes are upgraded on login
+	Auth.processes = 2			# 0: hash on the request thread
+	Auth.concurrency = 8		# hashes in flight from this process
+	Auth.queue_timeout = 2.0	# seconds, then ServiceUnavailable (503)
+Auth is a hook: the pool is started on setup and again in each worker of
+twist.server (on_fork), before any thread runs, since forking a threaded
+process may leave the children with locks held forever.
+'''
+import os
+import time
 import bcrypt
 import inspect
+import threading
+import multiprocessing
+from .twist import ServiceUnavailable
+from .hook import Hook
+
+def _hash(password, salt):
+	# runs in a pool process; never raises, so the slot is always released
+	try:
+		return True, bcrypt.hashpw(password, salt)
+	except Exception as e:
+		return False, e
+
+class Slots (object):
+	''' Counting semaphore whose acquire takes a timeout. '''
+	def __init__(self, n):
+		self.free = n
+		self.cond = threading.Condition()
+
+	def acquire(self, timeout):
+		deadline = time.time() + timeout
+		with self.cond:
+			while self.free <= 0:
+				left = deadline - time.time()
+				if left <= 0:
+					return False
+				self.cond.wait(left)
+			self.free -= 1
+			return True
+
+	def release(self, *args):
+		with self.cond:
+			self.free += 1
+			self.cond.notify()
+
+class Auth (Hook):
+	rounds = 12
+	processes = 2
+	concurrency = 8
+	queue_timeout = 2.0
 
-class Auth (object):
 	def __init__(self, db, roles=1):
 		self.db = db
 		self._roles = roles
+		self.pool = None
+		self.pool_pid = None
+		self.slots = Slots(self.concurrency)
+		self.lock = threading.Lock()
 		with self.db:
 			self.db.execute(Auth.auth_table)
+		self.register('Auth')
+
+	def start_pool(self):
+		self.pool = multiprocessing.Pool(self.processes)
+		self.slots = Slots(self.concurrency)
+		self.pool_pid = os.getpid()
+
+	def get_pool(self):
+		# fallback when no hook event started the pool in this process;
+		# a pool inherited through fork has lost its handler threads
+		if self.pool_pid != os.getpid():
+			with self.lock:
+				if self.pool_pid != os.getpid():
+					self.start_pool()
+		return self.pool
+
+	#-------------------------------------------------------------------
+	# Hook API
+
+	def on_setup(self):
+		if self.processes and self.pool_pid != os.getpid():
+			self.start_pool()
+
+	def on_fork(self):
+		# the parent's pool is left alone: its finalizer does nothing here
+		self.lock = threading.Lock()
+		self.slots = Slots(self.concurrency)
+		self.pool, self.pool_pid = None, None
+		if self.processes:
+			self.start_pool()
+
+	def on_teardown(self):
+		if self.pool is not None and self.pool_pid == os.getpid():
+			self.pool.close()
+			self.pool.join()
+		self.pool, self.pool_pid = None, None
+
+	def hashpw(self, password, salt=None):
+		''' bcrypt.hashpw on the pool; salt defaults to a new one of cost rounds '''
+		if isinstance(password, unicode):
+			password = password.encode('utf8')
+		if salt is None:
+			salt = bcrypt.gensalt(self.rounds)
+		pool = self.get_pool() if self.processes else None
+		deadline = time.time() + self.queue_timeout
+		if not self.slots.acquire(self.queue_timeout):
+			raise ServiceUnavailable('Too many password hashes in progress')
+		if pool is None:
+			try:
+				return bcrypt.hashpw(password, salt)
+			finally:
+				self.slots.release()
+		result = pool.apply_async(_hash, (password, salt), callback=self.slots.release)
+		try:
+			ok, value = result.get(max(deadline - time.time(), 0))
+		except multiprocessing.TimeoutError:
+			raise ServiceUnavailable('Password hashing timed out')
+		if not ok:
+			raise value
+		return value
+
+	def checkpw(self, password, hashed):
+		return self.hashpw(password, hashed) == hashed
+
+	def cost(self, hashed):
+		# $2b$12$...
+		try:
+			return int(hashed.split('$')[2])
+		except (IndexError, ValueError):
+			return None
 
 	@property
 	def roles(self):
@@ -35,7 +159,7 @@ class Auth (object):
 		return function_deco
 
 	def add_user(self, name, email, password, role=1):
-		hashed = bcrypt.hashpw(password, bcrypt.gensalt())
+		hashed = self.hashpw(password)
 		with self.db:
 			try:
 				self.db.execute("insert into auth (name,email,hashed,role) values \
@@ -49,27 +173,37 @@ class Auth (object):
 			self.db.execute("delete from auth where name=%s", (name,))
 
 	def update_user(self, name, email, password, role):
-		hashed = bcrypt.hashpw(password, bcrypt.gensalt())
+		hashed = self.hashpw(password)
 		with self.db:
-			self.db.execute("update auth set email=%s, hashed=%s role=%s \
+			self.db.execute("update auth set email=%s, hashed=%s, role=%s \
 				where name=%s", (email, hashed, role, name))
 
 	def authenticate(self, name, password):
 		rv = self.db.query('select role,hashed from auth where name=%s',(name,),1)
 		if not rv:
 			return 0
-		role, hashed = rv['role'], rv['hashed']
-		return role if bcrypt.hashpw(password, hashed)==hashed else -1
+		role, hashed = rv['role'], str(rv['hashed'])
+		if not self.checkpw(password, hashed):
+			return -1
+		if self.cost(hashed) != self.rounds:
+			# the cost factor was changed: upgrade the hash while we have the password
+			with self.db:
+				self.db.execute("update auth set hashed=%s where name=%s",
+					(self.hashpw(password), name))
+		return role
 
 	def login(self, name, password, session):
 		role = self.authenticate(name, password)
 		if role < 1:
 			return False
+		# a new session id with the new privileges
+		session.regenerate()
 		session['user'] = role
 		return True
 
 	def logout(self, session):
 		del session['user']
+		session.regenerate()
 
 	auth_table = '''create table if not exists auth (
   		uid serial primary key,
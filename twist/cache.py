@@ -0,0 +1,82 @@
+'''
+Bounded least-recently-used cache.
+
+	cache = LRUCache(1024)
+	cache['/article/update'] = value
+	cache.get('/article/update')
+
+Pass sizeof to bound the total size of the values instead of their count:
+	cache = LRUCache(8 << 20, sizeof=len)
+'''
+import threading
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache (object):
+	def __init__(self, maxsize=1024, sizeof=None):
+		self.maxsize = maxsize
+		self.sizeof = sizeof
+		self.lock = threading.RLock()
+		self.clear()
+
+	def clear(self):
+		# circular doubly linked list; root.NEXT is the oldest entry
+		with self.lock:
+			self.map = {}
+			self.size = 0
+			self.root = root = []
+			root[:] = [root, root, None, None]
+
+	def get(self, key, default=None):
+		with self.lock:
+			link = self.map.get(key)
+			if link is None:
+				return default
+			root = self.root
+			if link[NEXT] is not root:
+				link[PREV][NEXT] = link[NEXT]
+				link[NEXT][PREV] = link[PREV]
+				last = root[PREV]
+				last[NEXT] = root[PREV] = link
+				link[PREV], link[NEXT] = last, root
+			return link[VALUE]
+
+	def __setitem__(self, key, value):
+		with self.lock:
+			if key in self.map:
+				self.pop(key)
+			root = self.root
+			last = root[PREV]
+			last[NEXT] = root[PREV] = self.map[key] = [last, root, key, value]
+			self.size += self.sizeof(value) if self.sizeof else 1
+			while self.size > self.maxsize:
+				del self[root[NEXT][KEY]]
+
+	def __getitem__(self, key):
+		if key not in self.map:
+			raise KeyError(key)
+		return self.get(key)
+
+	def __delitem__(self, key):
+		with self.lock:
+			link = self.map.pop(key)
+			link[PREV][NEXT] = link[NEXT]
+			link[NEXT][PREV] = link[PREV]
+			self.size -= self.sizeof(link[VALUE]) if self.sizeof else 1
+
+	def __contains__(self, key):
+		return key in self.map
+
+	def __len__(self):
+		return len(self.map)
+
+	def pop(self, key, default=None):
+		with self.lock:
+			if key not in self.map:
+				return default
+			value = self.map[key][VALUE]
+			del self[key]
+			return value
+
+	def keys(self):
+		return self.map.keys()
@@ -0,0 +1,166 @@
+'''
+Filtering of in-memory rows with the Expression API, one column at a time:
+	table = Columns(Employee, employees)	# Model instances or dicts
+	table.filter((Employee.age > 30) & Employee.race.is_in(['Asian']))
+	table.indices(~(Employee.status == True))
+	table.mask(Employee.salary >= 50000)
+
+Columns are built on first use, from the field types: NumPy arrays when
+NumPy is installed (int64, float64, bool, datetime64, strings), plain
+lists otherwise. Expressions are evaluated as boolean masks over whole
+columns. As in SQL, None never satisfies a comparison; ~ negates the
+whole mask though, so ~(Employee.age < 30) also matches rows without age.
+'''
+import datetime
+import operator
+from .model import Model, Field, InvalidField, IntType, LongType, FloatType, \
+	BooleanType, DateType, DatetimeType
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+class Columns (object):
+	COMPARISONS = {'is_eq': operator.eq, 'is_ne': operator.ne,
+		'is_lt': operator.lt, 'is_le': operator.le,
+		'is_gt': operator.gt, 'is_ge': operator.ge}
+	# field type -> (numpy dtype, value standing in for None)
+	DTYPES = ((BooleanType, 'bool', False), (IntType, 'int64', 0),
+		(LongType, 'int64', 0), (FloatType, 'float64', 0.0),
+		(DatetimeType, 'datetime64[us]', None), (DateType, 'datetime64[D]', None))
+	EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+	def __init__(self, model, rows, use_numpy=True):
+		''' use_numpy=False, or NumPy not installed: pure Python columns '''
+		self.model = model
+		self.rows = list(rows)
+		self.numpy = numpy if use_numpy else None
+		self.columns = {}
+
+	def __len__(self):
+		return len(self.rows)
+
+	def column(self, name):
+		''' (values, nulls) of a field, built once '''
+		col = self.columns.get(name)
+		if col is not None:
+			return col
+		if name not in self.model._index:
+			raise InvalidField('"%s" is not a field of %s' % (name, self.model.table_name))
+		i = self.model._index[name]
+		t = self.model._types[i]
+		values = [r._values[i] if isinstance(r, Model) else t.value(r.get(name)) \
+			for r in self.rows]
+		nulls = [v is None for v in values]
+		if self.numpy is not None:
+			values, nulls = self.array(t, values), self.numpy.array(nulls, dtype=bool)
+		col = self.columns[name] = (values, nulls)
+		return col
+
+	def array(self, t, values):
+		np = self.numpy
+		for cls, dtype, fill in Columns.DTYPES:
+			if isinstance(t, cls):
+				break
+		else:
+			# strings: numpy infers the width; other types stay objects
+			dtype, fill = (None, '') if t.type is str else (object, None)
+		if fill is not None:
+			values = [fill if v is None else v for v in values]
+		if isinstance(t, DateType) and not isinstance(t, DatetimeType):
+			# numpy converts date objects one by one, slowly; day numbers are fast
+			epoch = Columns.EPOCH
+			days = [epoch if v is None else v.toordinal() for v in values]
+			return (np.array(days, dtype='int64') - epoch).astype(dtype)
+		if dtype == 'datetime64[us]':
+			values = np.array(values, dtype=object)
+		try:
+			return np.array(values, dtype=dtype)
+		except (OverflowError, ValueError, TypeError, UnicodeError):
+			return np.array(values, dtype=object)
+
+	def scalar(self, values, v):
+		''' operand in the representation of the column '''
+		if self.numpy is None or v is None:
+			return v
+		kind = values.dtype.kind
+		if kind == 'M':
+			return self.numpy.datetime64(v, values.dtype.name[11:-1])
+		if kind == 'S' and isinstance(v, unicode):
+			return v.encode('utf8')
+		if kind == 'U' and isinstance(v, str):
+			return v.decode('utf8')
+		return v
+
+	def mask(self, expr):
+		''' Boolean mask of the rows matching expr '''
+		name = expr.op.name
+		if name in ('is_both', 'is_either'):
+			a, b = self.mask(expr.operands[0]), self.mask(expr.operands[1])
+			if self.numpy is not None:
+				return a & b if name == 'is_both' else a | b
+			if name == 'is_both':
+				return [x and y for x, y in zip(a, b)]
+			return [x or y for x, y in zip(a, b)]
+		if name == 'is_not':
+			a = self.mask(expr.operands[0])
+			return ~a if self.numpy is not None else [not x for x in a]
+		if name == 'is_in' or name in Columns.COMPARISONS:
+			v = expr.operands[1]
+			v = v.value if isinstance(v, Field) else v
+			values, nulls = self.column(expr.field_name)
+			if name == 'is_in':
+				m = self.is_in(values, v)
+			else:
+				m = self.compare(Columns.COMPARISONS[name], values, v)
+			if self.numpy is not None:
+				return m & ~nulls
+			return [x and not n for x, n in zip(m, nulls)]
+		raise InvalidField('%s cannot be evaluated on columns' % name)
+
+	def compare(self, op, values, v):
+		if self.numpy is None or values.dtype == object:
+			m = [x is not None and op(x, v) for x in values]
+			return m if self.numpy is None else self.numpy.array(m, dtype=bool)
+		m = op(values, self.scalar(values, v))
+		if not isinstance(m, self.numpy.ndarray):
+			# numpy could not compare elementwise, e.g. bytes with text
+			m = self.numpy.array([op(x, v) for x in values], dtype=bool)
+		return m
+
+	def is_in(self, values, things):
+		things = set(things)
+		if self.numpy is None:
+			return [x in things for x in values]
+		if values.dtype == object:
+			return self.numpy.fromiter((x in things for x in values), bool, len(values))
+		return self.numpy.in1d(values, self.candidates(values, things))
+
+	def candidates(self, values, things):
+		''' things that exist in the dtype of the column; a cast would
+			truncate the others (e.g. 'abcd' to 'abc', 1.5 to 1) '''
+		np, kept = self.numpy, []
+		for x in things:
+			if x is None:
+				continue
+			x = self.scalar(values, x)
+			try:
+				c = np.array([x], dtype=values.dtype)
+			except (OverflowError, ValueError, TypeError, UnicodeError):
+				continue
+			if c[0] == x:
+				kept.append(c[0])
+		return np.array(kept, dtype=values.dtype)
+
+	def indices(self, expr):
+		''' Positions of the matching rows '''
+		m = self.mask(expr)
+		if self.numpy is not None:
+			return self.numpy.flatnonzero(m).tolist()
+		return [i for i, x in enumerate(m) if x]
+
+	def filter(self, expr):
+		''' The matching rows, as given '''
+		rows = self.rows
+		return [rows[i] for i in self.indices(expr)]
@@ -0,0 +1,72 @@
+'''
+NumPy and pure Python columns must agree:
+	python -m twist.columns_test
+'''
+import random
+import datetime
+from .model import *
+from .columns import Columns, numpy
+
+class Employee (Model):
+	name = 			Field('varchar')
+	age = 			Field('int')
+	salary = 		Field('float')
+	status = 		Field('boolean')
+	date_hired = 	Field('date')
+	last_meeting = 	Field('datetime')
+	big = 			Field('long')
+
+random.seed(7)
+rows = [dict(
+	name = random.choice(['abc', 'ab', 'abcd', u'abc', None]),
+	age = random.choice([None, 1, 2, 17, 30, 45]),
+	salary = random.choice([None, 0.5, 1.5, 20000.0]),
+	status = random.choice([None, True, False]),
+	date_hired = random.choice([None, datetime.date(2013, 2, 13), datetime.date(2001, 1, 1)]),
+	last_meeting = random.choice([None, datetime.datetime(2012, 7, 20, 11, 52, 27)]),
+	big = random.choice([None, 2**40, 2**40 + 1]),
+	) for i in range(500)]
+# an S3 column: 'abcd' must not be truncated to 'abc'
+short = [dict(r, name=random.choice(['abc', 'ab'])) for r in rows]
+
+exprs = [
+	Employee.name.is_in(['abcd']),
+	Employee.name.is_in([u'abc', 'zzzzzzz', None]),
+	Employee.age.is_in([1.5, 2]),
+	Employee.age.is_in(['x', 30]),
+	Employee.status.is_in([2]),
+	Employee.big.is_in([2**40 + 1, 2**70]),
+	Employee.salary.is_in([1.5]),
+	Employee.date_hired.is_in([datetime.date(2013, 2, 13)]),
+	(Employee.age > 16) & ~(Employee.name == 'abc'),
+	(Employee.salary < 1) | (Employee.status == False),
+	Employee.name < 'abcd',
+	Employee.name == 'abcd',
+	Employee.date_hired >= datetime.date(2010, 1, 1),
+	Employee.last_meeting == datetime.datetime(2012, 7, 20, 11, 52, 27),
+	~(Employee.age < 30),
+]
+
+def reference(expr, row):
+	''' row by row, as documented: None never satisfies a comparison '''
+	name = expr.op.name
+	if name == 'is_both':
+		return reference(expr.operands[0], row) and reference(expr.operands[1], row)
+	if name == 'is_either':
+		return reference(expr.operands[0], row) or reference(expr.operands[1], row)
+	if name == 'is_not':
+		return not reference(expr.operands[0], row)
+	v = row[expr.field_name]
+	if v is None:
+		return False
+	if name == 'is_in':
+		return v in expr.operands[1]
+	return Columns.COMPARISONS[name](v, expr.operands[1])
+
+for data in (rows, short, [Employee(r) for r in rows]):
+	fast, slow = Columns(Employee, data), Columns(Employee, data, use_numpy=False)
+	for e in exprs:
+		expected = [i for i, r in enumerate(data) if reference(e, r)]
+		assert slow.indices(e) == expected, str(e)
+		assert fast.indices(e) == expected, str(e)
+print 'columns: %d expressions agree%s' % (len(exprs), '' if numpy else ' (no NumPy)')
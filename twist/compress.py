@@ -0,0 +1,75 @@
+'''
+gzip compression of view responses, negotiated on Accept-Encoding.
+	Compression.level = 6
+	Compression.min_size = 1024		# smaller bodies are sent as they are
+	Compression.types += ('image/svg+xml',)
+Streamed responses are compressed chunk by chunk; each chunk is flushed
+so the client still receives it right away.
+'''
+import zlib
+
+class Compression (object):
+	enabled = True
+	level = 6
+	min_size = 1024
+	types = ('text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml',
+		'application/json', 'application/javascript', 'application/xml')
+
+	@classmethod
+	def accepts_gzip(cls, request):
+		''' gzip, or *, with a q above 0; an explicit gzip entry wins over * '''
+		q = {}
+		for item in request.headers.get('Accept-Encoding', '').split(','):
+			params = item.split(';')
+			coding = params[0].strip().lower()
+			if coding not in ('gzip', '*'):
+				continue
+			value = 1.0
+			for p in params[1:]:
+				p = p.strip()
+				if p.startswith('q='):
+					try:
+						value = float(p[2:])
+					except ValueError:
+						value = 0.0
+			q[coding] = value
+		return q.get('gzip', q.get('*', 0.0)) > 0
+
+	@classmethod
+	def apply(cls, request, response):
+		if not cls.enabled or response.content_type not in cls.types:
+			return
+		if response.status_int in (204, 304) or response.content_encoding:
+			return
+		vary = response.vary or ()
+		if 'Accept-Encoding' not in vary:
+			response.vary = tuple(vary) + ('Accept-Encoding',)
+		if request.method == 'HEAD' or not cls.accepts_gzip(request):
+			return
+		if isinstance(response.app_iter, list):
+			body = response.body
+			if len(body) < cls.min_size:
+				return
+			c = zlib.compressobj(cls.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			response.body = c.compress(body) + c.flush()
+		else:
+			response.app_iter = cls.stream(response.app_iter)
+			response.content_length = None
+		response.content_encoding = 'gzip'
+		if response.etag:
+			response.etag = response.etag + '-gz'
+
+	@classmethod
+	def stream(cls, chunks):
+		c = zlib.compressobj(cls.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		try:
+			for chunk in chunks:
+				if not chunk:
+					continue
+				data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+				if data:
+					yield data
+			yield c.flush()
+		finally:
+			if hasattr(chunks, 'close'):
+				chunks.close()
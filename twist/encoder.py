@@ -0,0 +1,70 @@
+'''
+JSON encoding through the fastest installed encoder.
+	Json.use('simplejson')		# or 'json'; default: simplejson if installed
+	Json.dumps(obj, default=view.serializer)
+	return Json.iter_array(Employee.find(expr, db))	# streamed JSON array
+
+ujson is only used when asked for with Json.use('ujson'): it truncates
+floats to 9 digits, turns dates into epoch numbers and unknown objects
+into {} without an error. Even then, calls that pass default, and rows
+that are not Models, go through the stdlib.
+'''
+import json
+
+class Json (object):
+	# name, supports default=
+	ENCODERS = (('simplejson', True), ('json', True), ('ujson', False))
+	# lossy, never picked by default
+	EXPLICIT_ONLY = ('ujson',)
+	name = 'json'
+	encode = staticmethod(json.dumps)
+	has_default = True
+
+	@classmethod
+	def use(cls, name=None):
+		for n, has_default in cls.ENCODERS:
+			if name is not None and n != name:
+				continue
+			if name is None and n in cls.EXPLICIT_ONLY:
+				continue
+			try:
+				module = __import__(n)
+			except ImportError:
+				continue
+			cls.name, cls.encode, cls.has_default = \
+				n, staticmethod(module.dumps), has_default
+			return n
+		raise ImportError('JSON encoder %s is not installed' % name)
+
+	@classmethod
+	def dumps(cls, obj, default=None):
+		if default is None:
+			return cls.encode(obj)
+		if cls.has_default:
+			return cls.encode(obj, default=default)
+		return json.dumps(obj, default=default)
+
+	@classmethod
+	def iter_array(cls, items, default=None, batch=100):
+		'''
+		Encode items as one JSON array, batch items per chunk.
+		Models are encoded through their precomputed serializer; other
+		items (e.g. iter_query rows) need an encoder with a default hook.
+		'''
+		yield '['
+		sep, buf = '', []
+		for item in items:
+			if hasattr(item, 'serializable'):
+				buf.append(cls.dumps(item.serializable(), default))
+			elif cls.has_default:
+				buf.append(cls.encode(item, default=default))
+			else:
+				buf.append(json.dumps(item, default=default))
+			if len(buf) == batch:
+				yield sep + ','.join(buf)
+				sep, buf = ',', []
+		if buf:
+			yield sep + ','.join(buf)
+		yield ']'
+
+Json.use()
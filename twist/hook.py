@@ -7,34 +7,88 @@ def on_setup(self):
 def on_teardown(self):
 	pass
 
+def on_fork(self):
+	# in each worker process started by the production server
+	pass
+
 def before_execute_view(self, view):
 	pass
 
 def after_execute_view(self, view):
 	pass
+
+def on_request_end(self):
+	# after every view, scoped or not, even when it failed or was interrupted
+	pass
+
+A hook runs for every view, unless it is scoped at registration
+	self.register('Audit', views=[ArticleUpdate], prefix='/admin')
+or with its decorator
+	@audit.scope
+	class ArticleUpdate(View): ...
 '''
 class Event ( list ):
 	def __init__(self, name):
 		self.name = name
+		# view class -> bound methods of the hooks in scope, built once
+		self.dispatch = {}
 
-	def __call__(self, *args, **kwargs):
-		for obj in self:
-			getattr(obj, self.name)(*args, **kwargs)
+	def __call__(self, *args):
+		view_cls = args[0].__class__ if args else None
+		try:
+			handlers = self.dispatch[view_cls]
+		except KeyError:
+			handlers = self.dispatch[view_cls] = [getattr(obj, self.name) \
+				for obj in self if obj.applies_to(view_cls)]
+		for f in handlers:
+			f(*args)
 
 	def append(self, obj):
 		if hasattr(obj, self.name):
 			super(Event, self).append(obj)
+			self.dispatch.clear()
 
 class Hook (object):
 	names = []
 	_on_setup = Event('on_setup')
 	_on_teardown = Event('on_teardown')
+	_on_fork = Event('on_fork')
 	_before_execute_view = Event('before_execute_view')
 	_after_execute_view = Event('after_execute_view')
+	_on_request_end = Event('on_request_end')
 
-	def register(self, name):
+	def register(self, name, views=None, prefix=None):
+		self.views = set(views) if views else set()
+		self.prefixes = [prefix.strip('/')] if prefix is not None else []
 		Hook.names.append(name)
 		Hook._on_setup.append(self)
 		Hook._on_teardown.append(self)
+		Hook._on_fork.append(self)
 		Hook._before_execute_view.append(self)
 		Hook._after_execute_view.append(self)
+		Hook._on_request_end.append(self)
+
+	def scope(self, view_cls):
+		''' Class decorator: run this hook for view_cls too. '''
+		self.views.add(view_cls)
+		Hook.invalidate()
+		return view_cls
+
+	def applies_to(self, view_cls):
+		if view_cls is None or not (self.views or self.prefixes):
+			return True
+		if view_cls in self.views:
+			return True
+		path = getattr(view_cls, '_path_', None)
+		if path is None:
+			return False
+		for p in self.prefixes:
+			if not p or path == p or path.startswith(p + '/'):
+				return True
+		return False
+
+	@classmethod
+	def invalidate(cls):
+		for event in (cls._on_setup, cls._on_teardown, cls._on_fork,
+				cls._before_execute_view, cls._after_execute_view, cls._on_request_end):
+			event.dispatch.clear()
@@ -0,0 +1,46 @@
+'''
+Per-request hook dispatch overhead:
+	python -m twist.hook_bench
+'''
+import timeit
+from .hook import Hook, Event
+from .twist import View
+
+class Api(View): pass
+class ApiUser(View): pass
+class Health(View): pass
+
+class Counter (Hook):
+	def __init__(self, i, **scope):
+		self.register('counter %d' % i, **scope)
+	def before_execute_view(self, view): pass
+	def after_execute_view(self, view): pass
+
+def legacy(event, *args, **kwargs):
+	# Event.__call__ before hooks were pre-bound
+	for obj in event:
+		getattr(obj, event.name)(*args, **kwargs)
+
+def reset():
+	Hook._before_execute_view = Event('before_execute_view')
+	Hook._after_execute_view = Event('after_execute_view')
+
+def request(view):
+	if Hook._before_execute_view:
+		Hook._before_execute_view(view)
+	if Hook._after_execute_view:
+		Hook._after_execute_view(view)
+
+print 'hooks  legacy  global  scoped/out-of-scope view (us/request)'
+for n in (0, 5, 20):
+	row = ['%5d' % n]
+	reset()
+	hooks = [Counter(i) for i in range(n)]
+	view = Health.__new__(Health)
+	row.append(min(timeit.repeat(lambda: (legacy(Hook._before_execute_view, view),
+		legacy(Hook._after_execute_view, view)), number=20000, repeat=3)))
+	row.append(min(timeit.repeat(lambda: request(view), number=20000, repeat=3)))
+	reset()
+	hooks = [Counter(i, prefix='/api') for i in range(n)]
+	row.append(min(timeit.repeat(lambda: request(view), number=20000, repeat=3)))
+	print ' '.join(['%s' % row[0]] + ['%7.2f' % (t / 20000 * 1e6) for t in row[1:]])
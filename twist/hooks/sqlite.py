@@ -1,24 +1,142 @@
 from ..hook import Hook
 import sqlite3
+import threading
 
 class Sqlite ( Hook ):
 	'''
 	Declare a global variable:
 		db = Sqlite('storage.sql')
-	In a view (no need to play around with cursors):
-		with db.con:
-			db.con.execute(...)
+	Writes go through the single writer connection, one thread at a time:
+		with db:
+			db.execute('insert into t values (?,?)', (1, 'a'))
+			db.executemany('insert into t values (?,?)', rows)
+	Reads use a connection per thread, which in WAL mode do not wait for
+	the writer:
+		db.query('select * from t where id=?', (1,), size=1)
+		for row in db.iter_query('select * from t', as_dict=False): ...
+	They see committed data only, not the writes of an open with block.
+	db.con is this thread's connection, for anything else.
+
+	An in-memory database is private to its connection, so ':memory:'
+	uses the writer connection for everything.
 	'''
+	pragmas = (
+		('journal_mode', 'WAL'),
+		('synchronous', 'NORMAL'),	# durable at checkpoints; safe with WAL
+		('cache_size', -8000),		# in KiB
+		('temp_store', 'MEMORY'),
+	)
+	cached_statements = 128		# per connection
+	timeout = 5.0				# seconds to wait for a lock
+
 	def __init__(self, dbname):
 		self.dbname = dbname
-		self.con = None
+		self.reset()
 		self.register('SQLite: '+dbname)
 
+	def reset(self):
+		self.local = threading.local()
+		self.lock = threading.Lock()			# connection bookkeeping
+		self.write_lock = threading.Lock()		# one write transaction at a time
+		self.writer = None
+		self.readers = []
+
+	def connect(self):
+		con = sqlite3.connect(self.dbname, timeout=self.timeout,
+			cached_statements=self.cached_statements, check_same_thread=False)
+		for name, value in self.pragmas:
+			con.execute('PRAGMA %s=%s' % (name, value))
+		return con
+
+	def get_writer(self):
+		if self.writer is None:
+			with self.lock:
+				if self.writer is None:
+					self.writer = self.connect()
+		return self.writer
+
+	@property
+	def con(self):
+		if self.dbname == ':memory:':
+			return self.get_writer()
+		con = getattr(self.local, 'con', None)
+		if con is None:
+			con = self.local.con = self.connect()
+			with self.lock:
+				self.readers.append(con)
+		return con
+
+	#-------------------------------------------------------------------
+	# Hook API
+
 	def on_setup(self):
 		print 'Connecting to', self.dbname
-		self.con = sqlite3.connect(self.dbname)
+		self.get_writer()
+
+	def on_fork(self):
+		# sqlite connections must not be shared with the parent process
+		self.reset()
 
 	def on_teardown(self):
-		if self.con is not None:
-			print 'Closing', self.dbname
-			self.con.close()
+		with self.lock:
+			cons, self.readers = self.readers, []
+			if self.writer is not None:
+				print 'Closing', self.dbname
+				cons.append(self.writer)
+				self.writer = None
+		for con in cons:
+			con.close()
+		self.local = threading.local()
+
+	#-------------------------------------------------------------------
+	def __enter__(self):
+		writer = self.get_writer()
+		self.write_lock.acquire()
+		self.local.cur = writer.cursor()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		try:
+			if exc_type: self.writer.rollback()
+			else: self.writer.commit()
+			self.local.cur.close()
+		finally:
+			self.local.cur = None
+			self.write_lock.release()
+
+	def get_cur(self):
+		cur = getattr(self.local, 'cur', None)
+		if cur is None:
+			raise Exception('Sqlite: writes must be inside a with statement.')
+		return cur
+
+	def execute(self, query, args=()):
+		self.get_cur().execute(query, args)
+
+	def executemany(self, query, rows):
+		''' Bulk write: rows is any iterable of parameter tuples '''
+		self.get_cur().executemany(query, rows)
+
+	def query(self, query, args=(), size=-1, as_dict=True):
+		cur = self.con.execute(query, args)
+		try:
+			rows = cur.fetchall() if size < 0 else cur.fetchmany(size)
+			if as_dict:
+				names = [d[0] for d in cur.description]
+				rows = [dict(zip(names, r)) for r in rows]
+		finally:
+			cur.close()
+		return (rows[0] if rows else None) if size==1 else rows
+
+	def iter_query(self, query, args=(), itersize=2000, as_dict=True):
+		''' Rows are fetched lazily, itersize at a time. '''
+		cur = self.con.execute(query, args)
+		try:
+			names = [d[0] for d in cur.description] if as_dict else None
+			while True:
+				rows = cur.fetchmany(itersize)
+				if not rows:
+					break
+				for r in rows:
+					yield dict(zip(names, r)) if as_dict else r
+		finally:
+			cur.close()
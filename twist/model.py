@@ -1,9 +1,12 @@
 import re
 import time
 import datetime
-import json
 import inspect
+import threading
+from collections import namedtuple
 from validator import *
+from cache import LRUCache
+from encoder import Json
 
 #--------------------------------------------------------------------
 # Types
@@ -15,12 +18,17 @@ class BaseType(object):
 
 	# return value of a string v, or object of the same type as self.type
 	def value(self, v):
-		if v==None: return None
+		if v==None or type(v) is self.type: return v
 		try:
 			return self.type(v)
 		except:
 			raise TypeError('"%s" is invalid of type %s' % (v,self.type))
 
+	def convert_many(self, values):
+		''' Column-wise conversion; values of the right type pass through '''
+		t, value = self.type, self.value
+		return [v if v is None or type(v) is t else value(v) for v in values]
+
 	def serialize(self, v):
 		return str(v)
 
@@ -36,6 +44,16 @@ class DatetimeType( BaseType ):
 		if isinstance(v, datetime.datetime): return v
 		if not isinstance(v, (str,unicode)):
 			raise TypeError('%s not an instance of Datetime' % str(v))
+		# fast path: YYYY-MM-DD HH:MM:SS[.ffffff], with ' ' or 'T'
+		n = len(v)
+		if (n == 19 or 21 <= n <= 26) and v[4] == v[7] == '-' and \
+				v[10] in ' T' and v[13] == v[16] == ':' and (n == 19 or v[19] == '.'):
+			try:
+				return datetime.datetime(int(v[0:4]), int(v[5:7]), int(v[8:10]),
+					int(v[11:13]), int(v[14:16]), int(v[17:19]),
+					int(v[20:].ljust(6, '0')) if n > 19 else 0)
+			except ValueError:
+				pass
 		if '.' in v:
 			(y, m, d, hh, mm, ss, t0, t1, t2) = time.strptime(v,'%Y-%m-%d %H:%M:%S.%f')
 		else:
@@ -52,6 +70,12 @@ class DateType( BaseType ):
 		if isinstance(v, datetime.date): return v
 		if not isinstance(v, (str,unicode)):
 			raise TypeError('%s not an instance of Date' % str(v))
+		# fast path: YYYY-MM-DD
+		if len(v) == 10 and v[4] == v[7] == '-':
+			try:
+				return datetime.date(int(v[0:4]), int(v[5:7]), int(v[8:10]))
+			except ValueError:
+				pass
 		(y, m, d, hh, mm, ss, t0, t1, t2) = time.strptime(v,'%Y-%m-%d')
 		return datetime.date(y, m, d)
 
@@ -67,6 +91,13 @@ class TimeType( BaseType ):
 		if isinstance(v, datetime.time): return v
 		if not isinstance(v, (str,unicode)):
 			raise TypeError('%s not an instance of Time' % str(v))
+		# fast path: HH:MM:SS and HH:MM
+		n = len(v)
+		if (n == 8 and v[2] == v[5] == ':') or (n == 5 and v[2] == ':'):
+			try:
+				return datetime.time(int(v[0:2]), int(v[3:5]), int(v[6:8]) if n==8 else 0)
+			except ValueError:
+				pass
 
 		''' Formats:
 			hh:mm:ss [am/pm]
@@ -74,6 +105,8 @@ class TimeType( BaseType ):
 			hh [am/pm]
 		'''
 		value = TimeType.REGEX_TIME.match(v.lower())
+		if value is None:
+			raise ValueError('"%s" is not a time' % v)
 		(h, m, s) = (int(value.group('h')), 0, 0)
 		if value.group('m') is not None:
 			m = int(value.group('m'))
@@ -173,22 +206,8 @@ class Expression(object):
 
 
 	def to_sql(self):
-		if self.op.name in ('is_eq','is_ne','is_lt','is_le','is_gt','is_ge', \
-				'is_in', 'is_notin'):
-			if isinstance(self.operands[1], Field):
-				values = [self.operands[1].value]
-			else:
-				values = [self.operands[1]]
-			return (self.op.sql(self.field_name, '%s'), values)
-		if self.op.name in ('is_both', 'is_either'):
-			L, L_values = self.operands[0].to_sql()
-			R, R_values = self.operands[1].to_sql()
-			return (self.op.sql(L,R), L_values + R_values)
-		if self.op.name in ('is_not',):
-			R, values =	self.operands[0].to_sql()
-			return (self.op.sql(R), values)
-		return ('', [''])
-
+		''' (sql, values); the sql text is cached by expression shape '''
+		return SQLCompiler.compile(self)
 
 	def to_mongo(self):
 		if self.op.name in ('is_eq','is_ne','is_lt','is_le','is_gt','is_ge', \
@@ -202,6 +221,46 @@ class Expression(object):
 			return self.op.mongo(self.operands[0].to_mongo())
 		return {}
 
+##---------------------------------------------------------------------
+class SQLCompiler(object):
+	'''
+	Expressions with the same operators, fields and models share one SQL
+	text; only their values are collected on each call. The list given to
+	is_in is bound as a single array parameter.
+	'''
+	COMPARISONS = ('is_eq','is_ne','is_lt','is_le','is_gt','is_ge','is_in')
+	cache = LRUCache(1024)
+
+	@classmethod
+	def compile(cls, expr):
+		values = []
+		key = cls.shape(expr, values)
+		sql = cls.cache.get(key)
+		if sql is None:
+			sql = cls.cache[key] = cls.sql(expr)
+		return (sql, values)
+
+	@classmethod
+	def shape(cls, expr, values):
+		name = expr.op.name
+		if name in cls.COMPARISONS:
+			v = expr.operands[1]
+			v = v.value if isinstance(v, Field) else v
+			values.append(list(v) if name == 'is_in' else v)
+			return (name, expr.field_name, expr.model_name)
+		if name in ('is_both', 'is_either', 'is_not'):
+			return (name,) + tuple(cls.shape(o, values) for o in expr.operands)
+		return (name,)
+
+	@classmethod
+	def sql(cls, expr):
+		name = expr.op.name
+		if name in cls.COMPARISONS:
+			return expr.op.sql(expr.field_name, '%s')
+		if name in ('is_both', 'is_either', 'is_not'):
+			return expr.op.sql(*[cls.sql(o) for o in expr.operands])
+		return ''
+
 ##---------------------------------------------------------------------
 class CUExpression ( Expression ):
 	''' Comparable unary expressions have only one operand.
@@ -252,6 +311,8 @@ class Field (CUExpression):
 		self.field_type = field_type
 		self.type = TypeFactory.get(field_type)
 		self.validators = validators
+		# key fields identify a row: Model.save upserts on them
+		self.key = kw.get('key', False)
 		e = Expression(is_value(), kw.get('value',None), self.type)
 		super(Field,self).__init__(combine_validators(validators), e)
 
@@ -272,108 +333,507 @@ class _Q (object):
 Q = _Q()
 
 ##---------------------------------------------------------------------
+class BoundField (Field):
+	''' Field view of one instance's value, created on each attribute access.
+		Shares type and validators with the class-level Field; the value
+		itself stays in the instance's row.
+	'''
+	def __init__(self, field, instance, index):
+		self.field_type = field.field_type
+		self.type = field.type
+		self.validators = field.validators
+		self.op = field.op
+		self.field_name = field.field_name
+		self.model_name = field.model_name
+		self.instance = instance
+		self.index = index
+
+	def get_value(self):
+		return self.instance._values[self.index]
+
+	def set_value(self, v):
+		self.instance._values[self.index] = self.type.value(v)
+
+	value = property(get_value, set_value)
+
+	@property
+	def operands(self):
+		return (self.instance._values[self.index],)
+
+
 class field_property(object):
-	def __init__(self, field_name):
+	def __init__(self, field_name, index):
 		self.field_name = field_name
+		self.index = index
 
 	def __get__(self, obj, objtype):
 		if obj is not None:
-			return obj.fields[self.field_name]
+			return obj.field(self.field_name)
 		else:
 			return objtype._fields[self.field_name]
 
 	def __set__(self, obj, value):
 		if obj != None:
-			obj.fields[self.field_name].value = value
+			obj._values[self.index] = obj._types[self.index].value(value)
 		else:
 			raise Exception('cannot assign value')
 
 
+def compile_validation(names, fields):
+	'''
+	Build one function that checks a row (list of values, in _names order)
+	against every validator of every field. Common validators are inlined;
+	the function returns (index, validator) of the first failure, or None.
+	'''
+	env, lines = {}, ['def check(row):']
+	for i, n in enumerate(names):
+		for j, v in enumerate(fields[n].validators):
+			key, x = 'v%d_%d' % (i, j), 'row[%d]' % i
+			env[key] = v
+			if isinstance(v, is_required):
+				test = '%s is not None' % x
+			elif isinstance(v, is_between):
+				env[key+'m'], env[key+'n'] = v.m, v.n
+				test = '%sm <= %s <= %sn' % (key, x, key)
+			elif isinstance(v, is_length):
+				env[key+'m'], env[key+'n'] = v.m, v.n
+				if v.n is None:
+					test = 'len(%s) == %sm' % (x, key)
+				else:
+					test = '%sm <= len(%s) <= %sn' % (key, x, key)
+			elif type(v) is is_in:
+				env[key+'t'] = v.things
+				test = '%s in %st' % (x, key)
+			else:
+				test = '%s(%s) != False' % (key, x)
+			lines.append('\tif not (%s): return (%d, %s)' % (test, i, key))
+	lines.append('\treturn None')
+	exec compile('\n'.join(lines), '<validation>', 'exec') in env
+	return env['check']
+
 class ModelMeta(type):
 	def __new__(cls, name, bases, dct):
 		# Model._fields is a class variable
-		dct['_fields'] = {}
-		klass = type.__new__(cls, name, bases, dct)
+		fields = {}
+		for base in reversed(bases):
+			fields.update(getattr(base, '_fields', {}))
 		for a in dct:
 			if isinstance(dct[a], Field):
-				field = dct[a]
-				field.field_name = a
-				field.model_name = name
-				klass._fields[a] = field
-				setattr(klass, a, field_property(a))
-		return klass
+				dct[a].field_name = a
+				dct[a].model_name = name
+				fields[a] = dct[a]
+		dct['_fields'] = fields
+		dct.setdefault('__slots__', ())
+
+		# compiled row layout: instances only hold a list of raw values
+		dct['_names'] = tuple(sorted(fields))
+		dct['_index'] = dict((n, i) for i, n in enumerate(dct['_names']))
+		dct['_types'] = tuple(fields[n].type for n in dct['_names'])
+		dct['_defaults'] = tuple(fields[n].value for n in dct['_names'])
+		dct['_serializers'] = tuple(t.serialize for t in dct['_types'])
+		dct['_check'] = staticmethod(compile_validation(dct['_names'], fields))
+		dct['_keys'] = tuple(n for n in dct['_names'] if fields[n].key)
+		dct['table_name'] = name
+		for n, i in dct['_index'].items():
+			dct[n] = field_property(n, i)
+		return type.__new__(cls, name, bases, dct)
 
 class Model(object):
 	__metaclass__ = ModelMeta
+	__slots__ = ('db', '_values')
 
 	def __init__(self, instance=None, db=None):
 		self.db = db
-		self.table_name = self.__class__.__name__
-
-		# "fields" is an instance variable copied from class variable "_fields"
-		self.fields = {}
-		for n, f in self._fields.items():
-			field = Field(
-						f.field_type,
-						*f.validators,
-						value=f.value
-			)
-			field.field_name = f.field_name
-			field.model_name = f.model_name
-			self.fields[n] = field
+		self._values = list(self._defaults)
 
 		if instance:
+			index, types, values = self._index, self._types, self._values
 			if isinstance(instance, dict):
 				for n, v in instance.items():
-					if n in self.fields:
-						setattr(self, n, v)
+					i = index.get(n)
+					if i is not None:
+						values[i] = types[i].value(v)
 			else:
-				for n in self.fields:
+				for n, i in index.items():
 					if hasattr(instance, n):
-						setattr(self, n, getattr(instance, n))
+						values[i] = types[i].value(getattr(instance, n))
+
+	def field(self, name):
+		''' Field for the expression API, e.g. e.field('age') < 50 '''
+		# not cached on the instance: that would make a reference cycle,
+		# and rows would wait for the cyclic GC instead of refcounting
+		return BoundField(self._fields[name], self, self._index[name])
+
+	@property
+	def fields(self):
+		return dict((n, self.field(n)) for n in self._names)
+
+	def __getitem__(self, name):
+		return self._values[self._index[name]]
 
-	def _save_postgresql(self, names, values):
+	def __setitem__(self, name, value):
+		i = self._index[name]
+		self._values[i] = self._types[i].value(value)
+
+	def _save_postgresql(self, names, values, keys=()):
 		sql = 'INSERT INTO %s (%s) VALUES'%(self.table_name, ', '.join(names))
 		sql += ' ('+ ', '.join(['%s']*len(values)) +')'
+		if keys:
+			sql += ' ON CONFLICT (%s) DO ' % ', '.join(keys)
+			others = [n for n in names if n not in keys]
+			if others:
+				sql += 'UPDATE SET ' + ', '.join(['%s = EXCLUDED.%s' % (n, n) \
+					for n in others])
+			else:
+				sql += 'NOTHING'
 		return sql
 
 	# if self exists, save --> update
-	def save(self):
-		names = [ n for n,f in self.fields.items() ]
-		values = tuple( f.value for n,f in self.fields.items() )
-		sql = self._save_postgresql(names, values)
+	def save(self, upsert=True):
+		'''
+		Insert this row; with key fields declared, e.g.
+			email = Field('varchar', key=True)
+		an existing row with the same keys is updated instead, in the same
+		statement. upsert=False always inserts.
+		'''
+		names = self._names
+		values = tuple(self._values)
+		sql = self._save_postgresql(names, values, self._keys if upsert else ())
 		if self.db != None:
 			with self.db:
-				db.execute(sql, values)
+				self.db.execute(sql, values)
 		else:
 			return sql, values
 
-	# Employee.update(('age', 20), ('name', 'John'), query)
-	# e.update(('age', 20), ('name', 'John'), key=('name',))
 	@classmethod
-	def update(self, expr):
-		''' update <table> set <column> = <expr> where <condition>'''
-		pass
+	def save_many(cls, instances, db=None, batch_size=1000, method='values'):
+		'''
+		Validate all instances, then insert them batch_size rows at a time
+		with multi-row INSERT ... VALUES (method='values') or with
+		COPY ... FROM STDIN (method='copy'). Returns SaveStats, or the
+		list of (sql, values) batches when db is None.
+		'''
+		assert method in ('values', 'copy')
+		start = time.time()
+		instances = list(instances)
+		errors = cls.validate_many(instances)
+		if errors:
+			raise InvalidField('; '.join('row %d: %s' % (i, errors[i]) \
+				for i in sorted(errors)))
+
+		names = cls._names
+		table_name = cls.table_name
+		batches = []
+		for i in range(0, len(instances), batch_size):
+			rows = [inst._values for inst in instances[i:i+batch_size]]
+			if method == 'copy' and db is not None:
+				sql = 'COPY %s (%s) FROM STDIN' % (table_name, ', '.join(names))
+				batches.append((sql, rows))
+			else:
+				sql = 'INSERT INTO %s (%s) VALUES ' % (table_name, ', '.join(names))
+				row = '(' + ', '.join(['%s']*len(names)) + ')'
+				sql += ', '.join([row]*len(rows))
+				batches.append((sql, tuple(v for r in rows for v in r)))
+		if db is None:
+			return batches
+
+		with db:
+			for sql, values in batches:
+				if method == 'copy':
+					db.copy_expert(sql, CopyStream(values))
+				else:
+					db.execute(sql, values)
+		elapsed = time.time() - start
+		return SaveStats(len(instances), elapsed, \
+			len(instances) / elapsed if elapsed else float('inf'))
 
 	@classmethod
-	def find(self, expr):
-		query = 'SELECT FROM %s WHERE %s;'
+	def update(cls, expr, db=None, **assignments):
+		'''
+		update <table> set <column> = <value>, ... where <condition>
+			Employee.update(Employee.age > 65, db, status='retired')
+		One statement for all matching rows; expr=None updates every row.
+		Returns the number of rows updated, or (sql, values) when db is None.
+		'''
+		if not assignments:
+			raise InvalidField('update() requires at least one assignment')
+		names = sorted(assignments)
+		Query(cls).check(*names)
+		values = []
+		for n in names:
+			i = cls._index[n]
+			v = cls._types[i].value(assignments[n])
+			validator = cls._fields[n].op
+			with Model._error_lock:
+				if not validator(v):
+					raise InvalidField('"%s" - %s' % (n, validator.error))
+			values.append(v)
+		sql = 'UPDATE %s SET %s' % (cls.table_name, \
+			', '.join(['%s = %%s' % n for n in names]))
+		if expr is not None:
+			where, where_values = expr.to_sql()
+			sql += ' WHERE ' + where
+			values += where_values
+		if db is None:
+			return sql, tuple(values)
+		with db:
+			db.execute(sql, tuple(values))
+			return db.cur.rowcount
+
+	@classmethod
+	def find(cls, expr=None, db=None):
+		'''
+		Lazy query; nothing runs until it is iterated.
+			for e in Employee.find(Employee.age > 30, db).only('name').limit(10):
+		'''
+		return Query(cls, expr, db)
+
+	@classmethod
+	def from_row(cls, names, row, db=None):
+		''' Instance from a database row; values are taken as they come. '''
+		obj = cls.__new__(cls)
+		obj.db = db
+		if names is cls._names:
+			obj._values = list(row)
+		else:
+			obj._values = values = list(cls._defaults)
+			index = cls._index
+			for n, v in zip(names, row):
+				values[index[n]] = v
+		return obj
 
 	def validate(self):
-		for name, field in self.fields.items():
-			if field.eval() == False:
-				raise InvalidField('"%s" - %s' % (field.field_name, field.op.error))
+		failed = self._check(self._values)
+		if failed is not None:
+			raise InvalidField(self._error(failed, self._values))
 		return True
 
+	@classmethod
+	def validate_many(cls, rows):
+		'''
+		Validate Model instances or dicts of raw values.
+		Returns {row index: error message} for the rows that fail.
+		'''
+		errors = {}
+		check, index, types = cls._check, cls._index, cls._types
+		for k, row in enumerate(rows):
+			if isinstance(row, Model):
+				values = row._values
+			else:
+				values = list(cls._defaults)
+				try:
+					for n, v in row.items():
+						i = index.get(n)
+						if i is not None:
+							values[i] = types[i].value(v)
+				except (TypeError, ValueError, AttributeError) as e:
+					# e.g. '2013-02-30' or '13/02/2013' for a date
+					errors[k] = '"%s" - %s' % (n, e)
+					continue
+			failed = check(values)
+			if failed is not None:
+				errors[k] = cls._error(failed, values)
+		return errors
+
+	_error_lock = threading.Lock()
+
+	@classmethod
+	def _error(cls, failed, values):
+		# error text is only built for rows that fail; validators keep it
+		# on themselves and are shared by all threads
+		i, validator = failed
+		with Model._error_lock:
+			validator(values[i])
+			return '"%s" - %s' % (cls._names[i], validator.error)
+
 	def to_dict(self):
-		return { name:field.value for name,field in self.fields.items() }
+		return dict(zip(self._names, self._values))
+
+	def serializable(self):
+		return dict(zip(self._names, \
+			[f(v) for f, v in zip(self._serializers, self._values)]))
 
 	def to_json(self):
-		d = {name:field.serialize() for name,field in self.fields.items()}
-		return json.dumps(d)
+		return Json.dumps(self.serializable())
 
 	def __str__(self):
-	 	return '\n'.join(str(field) for name,field in self.fields.items())
+	 	return '\n'.join(str(v) for v in self._values)
 
 	def __repr__(self):
-	 	return '\n'.join(repr(field) for name,field in self.fields.items())
+	 	return '\n'.join(repr(self.field(n)) for n in self._names)
+
+##---------------------------------------------------------------------
+class Query(object):
+	'''
+	Chainable, immutable query over one model:
+		q = Employee.find(Employee.status == True, db)
+		q.only('name', 'age').order_by('age').limit(50)
+		q.order_by('uid').after(last_uid).limit(100)	# keyset pagination
+		q.count(), q.exists()
+	Keyset pagination needs a unique order: the key fields of the model
+	(Field(..., key=True)) follow the order_by column in ORDER BY and in
+	the keyset, so rows that tie on the order_by column are never skipped.
+	Rows are streamed from a server-side cursor and hydrated one at a time.
+	'''
+	def __init__(self, model, expr=None, db=None):
+		self.model = model
+		self.expr = expr
+		self.db = db
+		self.columns = model._names
+		self.limit_ = None
+		self.offset_ = None
+		self.order = None
+		self.last = None
+
+	def clone(self, **kw):
+		q = Query.__new__(Query)
+		q.__dict__.update(self.__dict__)
+		q.__dict__.update(kw)
+		return q
+
+	def check(self, *names):
+		for n in names:
+			if n not in self.model._index:
+				raise InvalidField('"%s" is not a field of %s' % (n, self.model.table_name))
+
+	def only(self, *columns):
+		self.check(*columns)
+		return self.clone(columns=columns)
+
+	def limit(self, n):
+		return self.clone(limit_=n)
+
+	def offset(self, n):
+		return self.clone(offset_=n)
+
+	def order_by(self, column, desc=False):
+		self.check(column)
+		return self.clone(order=(column, desc))
+
+	def ordering(self):
+		''' order_by column, then the key fields as tie-breakers '''
+		column = self.order[0]
+		return (column,) + tuple(k for k in self.model._keys if k != column)
+
+	def after(self, *values):
+		'''
+		Keyset pagination: rows past values, given for the columns of
+		ordering() (the order_by column, then the key fields). With the
+		order_by value alone, rows that tie with it are skipped.
+		'''
+		if self.order is None:
+			raise InvalidField('after() requires order_by()')
+		if not 0 < len(values) <= len(self.ordering()):
+			raise InvalidField('after() takes values for %s' % ', '.join(self.ordering()))
+		return self.clone(last=values)
+
+	def where(self):
+		sql, values = self.expr.to_sql() if self.expr is not None else ('', [])
+		if self.last is not None:
+			columns, op = self.ordering()[:len(self.last)], '<' if self.order[1] else '>'
+			if len(columns) == 1:
+				keyset = '%s %s %%s' % (columns[0], op)
+			else:
+				# row comparison: (age, uid) > (%s, %s)
+				keyset = '(%s) %s (%s)' % (', '.join(columns), op, \
+					', '.join(['%s'] * len(columns)))
+			sql = '(%s AND %s)' % (sql, keyset) if sql else keyset
+			values = values + list(self.last)
+		return (' WHERE ' + sql if sql else ''), values
+
+	def selected(self):
+		# the keyset columns are always fetched
+		if self.order:
+			extra = tuple(c for c in self.ordering() if c not in self.columns)
+			if extra:
+				return tuple(self.columns) + extra
+		return self.columns
+
+	def sql(self):
+		columns = self.selected()
+		where, values = self.where()
+		sql = 'SELECT %s FROM %s%s' % (', '.join(columns), self.model.table_name, where)
+		if self.order:
+			desc = ' DESC' if self.order[1] else ''
+			sql += ' ORDER BY ' + ', '.join(c + desc for c in self.ordering())
+		if self.limit_ is not None:
+			sql += ' LIMIT %d' % self.limit_
+		if self.offset_ is not None:
+			sql += ' OFFSET %d' % self.offset_
+		return sql, values
+
+	def __iter__(self):
+		sql, values = self.sql()
+		names = self.selected()
+		from_row, db = self.model.from_row, self.db
+		for row in self.db.iter_query(sql, values, as_dict=False):
+			yield from_row(names, row, db)
+
+	def pages(self, size):
+		'''
+		Lists of at most size instances, fetched by keyset pagination.
+		The model must declare key fields, to order rows uniquely.
+		'''
+		if self.order is None:
+			raise InvalidField('pages() requires order_by()')
+		if not self.model._keys:
+			raise InvalidField('pages() requires key fields on %s, to break ties' \
+				% self.model.table_name)
+		columns = self.ordering()
+		q = self.limit(size)
+		while True:
+			page = list(q)
+			if page:
+				yield page
+			if len(page) < size:
+				return
+			last = page[-1]
+			q = q.after(*[last[c] for c in columns])
+
+	def count(self):
+		where, values = self.where()
+		sql = 'SELECT count(*) AS n FROM %s%s' % (self.model.table_name, where)
+		return self.db.query(sql, values, 1)['n']
+
+	def exists(self):
+		where, values = self.where()
+		sql = 'SELECT EXISTS (SELECT 1 FROM %s%s) AS e' % (self.model.table_name, where)
+		return self.db.query(sql, values, 1)['e']
+
+SaveStats = namedtuple('SaveStats', ['rows', 'seconds', 'rows_per_sec'])
+
+class CopyStream(object):
+	''' File-like object producing COPY text format from rows, lazily. '''
+	ESCAPES = {'\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r'}
+	REGEX = re.compile(r'[\\\t\n\r]')
+	FLOATS = {'inf': 'Infinity', '-inf': '-Infinity', 'nan': 'NaN'}
+
+	def __init__(self, rows):
+		self.rows = iter(rows)
+		self.buffer = ''
+
+	def format(self, value):
+		if value is None:
+			return '\\N'
+		if isinstance(value, unicode):
+			value = value.encode('utf8')
+		elif isinstance(value, float):
+			# str() keeps only 12 significant digits in Python 2
+			value = CopyStream.FLOATS.get(repr(value), repr(value))
+		elif not isinstance(value, str):
+			# Decimal, date, time and datetime: str() is their ISO/exact text
+			value = str(value)
+		return CopyStream.REGEX.sub(lambda m: CopyStream.ESCAPES[m.group()], value)
+
+	def read(self, size=-1):
+		while size < 0 or len(self.buffer) < size:
+			row = next(self.rows, None)
+			if row is None:
+				break
+			self.buffer += '\t'.join(self.format(v) for v in row) + '\n'
+		if size < 0:
+			size = len(self.buffer)
+		chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+		return chunk
+
+	readline = read
@@ -0,0 +1,41 @@
+'''
+Model instance benchmark:
+	python -m twist.model_bench [rows]
+'''
+import sys
+import time
+from .model import *
+
+class Employee (Model):
+	name = 			Field('var', is_length(1, 30))
+	age = 			Field('int', is_required(), is_between(17,35))
+	salary = 		Field('float', is_between(10000,100000), value=20000)
+	race = 			Field('varchar', is_in('Asian', 'Caucasian', 'African'))
+	status = 		Field('boolean', value=False)
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+rows = [dict(name='Employee %d' % i, age=18 + i % 17, race='Asian') for i in range(N)]
+
+def timed(label, f):
+	start = time.time()
+	rv = f()
+	elapsed = time.time() - start
+	print '%-22s %7.3fs  %6.2f us/row' % (label, elapsed, elapsed / N * 1e6)
+	return rv
+
+def legacy_construct():
+	# what Model.__init__ used to allocate: one full Field per column
+	for r in rows:
+		fields = {}
+		for n, f in Employee._fields.items():
+			fields[n] = Field(f.field_type, *f.validators, value=r.get(n, f.value))
+
+print '%d rows' % N
+timed('legacy construct', legacy_construct)
+employees = timed('construct', lambda: [Employee(r) for r in rows])
+timed('item access', lambda: [e['age'] for e in employees])
+timed('to_dict', lambda: [e.to_dict() for e in employees])
+timed('attribute (Field)', lambda: [e.age for e in employees])
+timed('expression e.age < 30', lambda: [(e.age < 30).eval() for e in employees])
+timed('validate', lambda: [e.validate() for e in employees])
+timed('validate_many (dicts)', lambda: Employee.validate_many(rows))
@@ -2,26 +2,131 @@
 db = Postgres(database, user, password)
 with db:
 	db.execute(sql, values)
+Each thread gets its own connection, so transactions never mix.
 
+Pooled mode, one connection checked out per request and per thread:
+db = Postgres(database, user, password, pool=(2, 10), timeout=5)
+It goes back to the pool when the request ends, however it ends. A
+request that waits more than timeout seconds gets 503 (PoolTimeout).
+Only for some views (see Hook):
+db = Postgres(database, user, password, pool=(2, 10), prefix='/api')
+
+Streaming a large result from a view, with constant memory:
+	def get(self):
+		return ('%(id)s,%(name)s\n' % r for r in db.iter_query(sql, args))
 '''
+import time
+import itertools
+import threading
 import psycopg2
+import psycopg2.extensions
+from .hook import Hook
+from .twist import ServiceUnavailable
+
+class Postgres (Hook):
+	cursor_ids = itertools.count()
 
-class Postgres (object):
-	def __init__(self, database, user, password, model_file=None):
+	def __init__(self, database, user, password, model_file=None,
+			pool=None, timeout=10, views=None, prefix=None):
 		print 'Postgres: connecting to', database
-		self.con=psycopg2.connect(database=database,user=user,password=password)
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.kw = dict(database=database, user=user, password=password)
+		self.pool = None
+		self.connections = []	# unpooled: one per thread of this process
+		self.inherited = []		# kept open for the parent process, see on_fork
+		if pool:
+			self.pool = ConnectionPool(pool[0], pool[1], timeout, **self.kw)
+		else:
+			self.con
+		self.register('Postgres: '+database, views, prefix)
 		self.cur = None
 		if model_file:
 			with open(model_file) as f:
 				q = f.read()
 				with self:
 					self.cur.execute(q)
+			self.release()
 
 	def __del__(self):
-		if not self.con.closed:
-			print 'Postgres: closing connection'
-			self.con.close()
+		if self.pool is not None:
+			self.pool.closeall()
+		for con in self.connections:
+			if not con.closed:
+				print 'Postgres: closing connection'
+				con.close()
+
+	@property
+	def con(self):
+		''' This thread's connection, from the pool in pooled mode '''
+		con = getattr(self.local, 'con', None)
+		if con is None:
+			if self.pool is not None:
+				con = self.pool.getconn()
+			else:
+				con = psycopg2.connect(**self.kw)
+				with self.lock:
+					self.connections.append(con)
+			self.local.con = con
+		return con
+
+	def release(self):
+		''' Return this thread's connection to the pool '''
+		con = getattr(self.local, 'con', None)
+		if self.pool is not None and con is not None:
+			self.local.con = None
+			self.pool.putconn(con)
+
+	def take_con(self):
+		''' (connection, owned): an owned connection is returned with putconn '''
+		if self.pool is None:
+			return self.con, False
+		con = getattr(self.local, 'con', None)
+		if con is None:
+			return self.pool.getconn(), True
+		cur = self.cur
+		if cur is not None and not cur.closed:
+			# inside a with block: share its transaction
+			return con, False
+		self.local.con = None
+		return con, True
+
+	def get_cur(self):
+		return getattr(self.local, 'cur', None)
+
+	def set_cur(self, cur):
+		self.local.cur = cur
+
+	cur = property(get_cur, set_cur)
+
+	#-------------------------------------------------------------------
+	# Hook API
+
+	def before_execute_view(self, view):
+		# a connection left over by an aborted request is reused
+		if self.pool is not None:
+			self.con
+
+	def on_request_end(self):
+		# also for views out of scope, which check out connections lazily
+		self.release()
 
+	def on_teardown(self):
+		if self.pool is not None:
+			self.pool.closeall()
+
+	def on_fork(self):
+		# connections of the parent process must be neither used nor closed
+		# (nor garbage collected): closing ends the session on the socket
+		# the parent shares. This process connects anew.
+		if self.pool is not None:
+			self.pool.forget()
+		self.inherited.extend(self.connections)
+		self.connections = []
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	#-------------------------------------------------------------------
 	def __enter__(self):
 		if self.con.closed:
 			raise Exception('Postgres: connection is already closed.')
@@ -40,6 +145,12 @@ class Postgres (object):
 		else:
 			self.cur.execute(query)
 
+	def copy_expert(self, sql, f):
+		''' COPY ... FROM STDIN reading from the file-like object f '''
+		if not self.cur or self.cur.closed:
+			raise Exception('Postgres: copy_expert must inside a with statement.')
+		self.cur.copy_expert(sql, f)
+
 	def query(self, query, args=(), size=-1):
 		cur = self.con.cursor()
 		cur.execute(query, args)
@@ -48,4 +159,121 @@ class Postgres (object):
 		cur.close()
 		return (rv[0] if rv else None) if size==1 else rv
 
+	def iter_query(self, query, args=(), itersize=2000, as_dict=True):
+		'''
+		Rows are fetched lazily, itersize at a time, through a named
+		server-side cursor. In pooled mode the generator holds its own
+		connection until it is exhausted or closed, so it can be returned
+		from a view as a streamed response. That is the thread's connection
+		if one is checked out (a thread never waits for a second one), else
+		a new one from the pool.
+		'''
+		con, own = self.take_con()
+		cur = con.cursor(name='twist_%d' % next(Postgres.cursor_ids))
+		cur.itersize = itersize
+		try:
+			cur.execute(query, args)
+			names = None
+			for r in cur:
+				if not as_dict:
+					yield r
+					continue
+				if names is None:
+					names = [d.name for d in cur.description]
+				yield dict(zip(names, r))
+		finally:
+			if not cur.closed:
+				cur.close()
+			if own:
+				self.pool.putconn(con)
+
 #-----------------------------------------------------------------------
+class PoolTimeout (ServiceUnavailable):
+	pass
+
+class ConnectionPool (object):
+	'''
+	Thread-safe pool of at most maxconn connections.
+	getconn() waits up to timeout seconds for a free connection, and pings
+	connections that have been idle longer than check_idle seconds.
+	'''
+	def __init__(self, minconn, maxconn, timeout=10, check_idle=30, **kw):
+		self.kw = kw
+		self.maxconn = maxconn
+		self.timeout = timeout
+		self.check_idle = check_idle
+		self.cond = threading.Condition()
+		self.idle = [(psycopg2.connect(**kw), time.time()) for i in range(minconn)]
+		self.size = minconn
+
+	def getconn(self):
+		deadline = time.time() + self.timeout
+		with self.cond:
+			while not self.idle and self.size >= self.maxconn:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise PoolTimeout('Postgres: no connection available after %ss' \
+						% self.timeout)
+				self.cond.wait(remaining)
+			if self.idle:
+				con, since = self.idle.pop()
+			else:
+				con, since = None, None
+				self.size += 1
+		if con is not None:
+			if self.alive(con, since):
+				return con
+			if not con.closed:
+				con.close()
+		try:
+			return psycopg2.connect(**self.kw)
+		except:
+			with self.cond:
+				self.size -= 1
+				self.cond.notify()
+			raise
+
+	def putconn(self, con):
+		if not con.closed and con.get_transaction_status() != \
+				psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+			try:
+				con.rollback()
+			except psycopg2.Error:
+				con.close()
+		with self.cond:
+			if con.closed:
+				self.size -= 1
+			else:
+				self.idle.append((con, time.time()))
+			self.cond.notify()
+
+	def alive(self, con, since):
+		if con.closed:
+			return False
+		if time.time() - since < self.check_idle:
+			return True
+		try:
+			cur = con.cursor()
+			cur.execute('SELECT 1')
+			cur.close()
+			con.rollback()
+		except psycopg2.Error:
+			return False
+		return True
+
+	def forget(self):
+		# after fork: the idle connections belong to the parent, they are
+		# kept referenced so that they are never closed from here
+		self.inherited = getattr(self, 'inherited', []) + \
+			[con for con, since in self.idle]
+		self.cond = threading.Condition()
+		self.idle = []
+		self.size = 0
+
+	def closeall(self):
+		with self.cond:
+			for con, since in self.idle:
+				if not con.closed:
+					con.close()
+			self.size -= len(self.idle)
+			self.idle = []
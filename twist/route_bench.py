@@ -0,0 +1,61 @@
+'''
+Routing microbenchmark; lookup cost should stay flat as views are added,
+and never exceed the cost of walking Route.table.
+	python -m twist.route_bench
+'''
+import timeit
+from .twist import View, Route
+
+PAGES = 50
+
+def register(first, last):
+	for i in range(first, last):
+		type('Section%d' % i, (View,), {})
+		for j in range(PAGES):
+			type('Section%dPage%d' % (i, j), (View,), {})
+
+def make_paths(sections):
+	step = max(1, sections/8)
+	exact = ['/section%d/page%d' % (i, j) \
+		for i in range(0, sections, step) for j in range(0, PAGES, 5)]
+	args = ['/section%d/page%d/%d/edit' % (i, j, i*j) \
+		for i in range(0, sections, step) for j in range(0, PAGES, 5)]
+	return exact, args
+
+def legacy(paths):
+	for p in paths:
+		Route.lookup_tokens(p.strip('/').split('/'), Route.table)
+
+def new(paths):
+	for p in paths:
+		Route.lookup(p)
+
+def cold(paths):
+	Route.misses = {}
+	for p in paths:
+		Route.lookup(p)
+
+def timed(f, paths):
+	t = min(timeit.repeat(lambda: f(paths), number=100, repeat=5))
+	return t / (100*len(paths)) * 1e6
+
+def bench(sections):
+	exact, args = make_paths(sections)
+	Route.compile()
+	for p in exact + args:
+		obj, params = Route.lookup_tokens(p.strip('/').split('/'), Route.table)
+		assert Route.lookup(p) == (obj, tuple(params)), p
+
+	row = [timed(legacy, exact), timed(new, exact),
+		timed(legacy, args), timed(cold, args), timed(new, args)]
+	print '%6d ' % len(Route.view) + ' '.join('%8.2f' % t for t in row)
+	assert row[1] <= row[0], 'exact lookup slower than the table walk'
+	assert row[4] <= row[2], 'cached lookup slower than the table walk'
+
+print ' views   legacy    exact   legacy     cold   cached  (us/lookup)'
+print '        (exact paths)      (paths with args)'
+done = 0
+for sections in (2, 20, 80):
+	register(done, sections)
+	done = sections
+	bench(sections)
@@ -0,0 +1,161 @@
+'''
+Pre-forking, multi-threaded WSGI server for production:
+	app.run(host, port, workers=4, threads=8, max_requests=10000)
+
+The master process loads the app (routes compiled, templates precompiled)
+and opens the listening socket, then forks the workers. Each worker
+serves requests with a pool of threads and exits after max_requests so
+that the master replaces it. Hooks get on_fork() in every new worker,
+and on_teardown() once it has finished its requests and deferred tasks.
+Workers share nothing in memory: MemorySessionStore, ResponseCache and
+the other in-process caches are per worker.
+
+Signals to the master:
+	SIGHUP			graceful restart: new workers are started, the old
+					ones finish their requests and exit
+	SIGTERM, SIGINT	graceful shutdown
+'''
+import os
+import errno
+import signal
+import socket
+import threading
+import Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from .hook import Hook
+from .tasks import Tasks
+
+class QuietHandler (WSGIRequestHandler):
+	def log_message(self, *args):
+		pass
+
+class WorkerServer (WSGIServer):
+	''' WSGIServer on an inherited socket; requests are handled by a pool of
+		threads, the accepting thread stays free.
+	'''
+	def __init__(self, sock, app, threads, handler=QuietHandler):
+		WSGIServer.__init__(self, sock.getsockname(), handler, bind_and_activate=False)
+		self.socket = sock
+		self.server_name, self.server_port = sock.getsockname()[:2]
+		self.setup_environ()
+		self.set_app(app)
+		self.timeout = 1
+		self.handled = 0
+		self.requests = Queue.Queue(threads)
+		for i in range(threads):
+			t = threading.Thread(target=self.work)
+			t.daemon = True
+			t.start()
+
+	def get_request(self):
+		conn, address = self.socket.accept()
+		conn.setblocking(1)
+		return conn, address
+
+	def process_request(self, request, client_address):
+		# blocks while every thread is busy: back pressure on accept
+		self.handled += 1
+		self.requests.put((request, client_address))
+
+	def work(self):
+		while True:
+			request, client_address = self.requests.get()
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+				self.requests.task_done()
+
+	def server_close(self):
+		# the listening socket belongs to the master
+		pass
+
+##------------------------------------------------------------------------##
+class Master (object):
+	def __init__(self, app, host, port, workers, threads, max_requests):
+		self.app = app
+		self.workers = workers
+		self.threads = threads
+		self.max_requests = max_requests
+		self.children = set()
+		self.signalled = set()		# children already sent SIGTERM
+		self.stopping = False
+		self.restarting = False
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind((host, port))
+		self.sock.listen(1024)
+		# several workers select() on the socket; losers must not block in accept
+		self.sock.setblocking(0)
+
+	def spawn(self):
+		pid = os.fork()
+		if pid:
+			self.children.add(pid)
+			return
+		try:
+			self.run_worker()
+		finally:
+			os._exit(0)
+
+	def run_worker(self):
+		for sig in (signal.SIGHUP, signal.SIGINT):
+			signal.signal(sig, signal.SIG_IGN)
+		running = [True]
+		def stop(*args):
+			running[0] = False
+		signal.signal(signal.SIGTERM, stop)
+		Hook._on_fork()
+		server = WorkerServer(self.sock, self.app, self.threads)
+		while running[0] and \
+				(not self.max_requests or server.handled < self.max_requests):
+			server.handle_request()
+		# finish requests in flight, then the tasks they deferred
+		server.requests.join()
+		Tasks.drain()
+		Hook._on_teardown()
+
+	def serve(self):
+		signal.signal(signal.SIGHUP, lambda *args: setattr(self, 'restarting', True))
+		signal.signal(signal.SIGTERM, lambda *args: setattr(self, 'stopping', True))
+		signal.signal(signal.SIGINT, lambda *args: setattr(self, 'stopping', True))
+		for i in range(self.workers):
+			self.spawn()
+		while self.children:
+			if self.stopping:
+				self.signal_children(signal.SIGTERM)
+			elif self.restarting:
+				self.restarting = False
+				old = set(self.children)
+				for i in range(self.workers):
+					self.spawn()
+				self.signal_children(signal.SIGTERM, old)
+			try:
+				pid, status = os.wait()
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			self.children.discard(pid)
+			self.signalled.discard(pid)
+			if not self.stopping and len(self.children) < self.workers:
+				self.spawn()
+		self.sock.close()
+
+	def signal_children(self, sig, pids=None):
+		''' each child is signalled once, however often this is called '''
+		for pid in (self.children if pids is None else pids):
+			if pid in self.signalled:
+				continue
+			self.signalled.add(pid)
+			try:
+				os.kill(pid, sig)
+			except OSError:
+				pass
+
+def serve(app, host='127.0.0.1', port=8000, workers=1, threads=8, max_requests=0):
+	print 'serving on port %d: %d workers, %d threads each' % (port, workers, threads)
+	Master(app, host, port, workers, threads, max_requests).serve()
+	print 'stop serving...'
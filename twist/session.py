@@ -1,19 +1,44 @@
+import os
+import json
+import time
+import sqlite3
+import datetime
+import binascii
+import threading
 from itsdangerous import URLSafeTimedSerializer, BadSignature
+from .cache import LRUCache
 
 SESSION_COOKIE_NAME = 'twist-session'
 
 class CookieSession(object):
+	''' Session data is signed into the cookie. It is written back when it
+		differs from what the request sent, in-place edits included:
+			self.session['cart'].append(item)
+	'''
 	def __init__(self, request, response, max_age=360, secret='xxx'):
 		self.request = request
 		self.response = response
 		self.max_age = max_age
 		self.serializer = URLSafeTimedSerializer(secret)
 		self.modified = False
+		self.issued = None
 		s = self.request.cookies.get(SESSION_COOKIE_NAME)
 		try:
-			self.session = self.serializer.loads(s) if s else {}
+			if s:
+				self.session, self.issued = self.serializer.loads(s, return_timestamp=True)
+			else:
+				self.session = {}
 		except BadSignature:
 			self.session = {}
+		self.loaded = self.serializer.dump_payload(self.session)
+
+	def refresh_due(self):
+		''' Expiry slides with activity: an unmodified session is re-issued
+			once its cookie is past half of max_age, not on every request '''
+		if self.issued is None:
+			return False
+		age = datetime.datetime.utcnow() - self.issued
+		return age.days * 86400 + age.seconds > self.max_age / 2
 
 	def get(self, key, default=None):
 		return self.session[key] if key in self.session else default
@@ -32,10 +57,16 @@ class CookieSession(object):
 	def __contains__(self, key):
 		return key in self.session
 
+	def regenerate(self):
+		''' Call on privilege changes (login, logout); see ServerSession '''
+		self.modified = True
+
 	def save(self):
+		if not self.modified and not (self.session and self.refresh_due()) and \
+				self.serializer.dump_payload(self.session) == self.loaded:
+			return
 		if not self.session:
-			if self.modified:
-				self.response.delete_cookie(SESSION_COOKIE_NAME,domain=domain)
+			self.response.delete_cookie(SESSION_COOKIE_NAME)
 			return
 		self.response.set_cookie(SESSION_COOKIE_NAME,
 								self.serializer.dumps(self.session),
@@ -45,3 +76,157 @@ class CookieSession(object):
 	def __str__(self):
 		return '<Session: %s>' % str(self.session)
 
+##------------------------------------------------------------------------##
+class ServerSession(CookieSession):
+	'''
+	Session data lives in a store; the cookie only carries a signed id.
+		View.setup(..., session_store=MemorySessionStore())
+	Only assignments and deletions mark the session modified. After an
+	in-place edit, set the flag or the change is not stored:
+		self.session['cart'].append(item)
+		self.session.modified = True
+	regenerate() moves the data to a new id; Auth.login and Auth.logout
+	call it, so an id planted before login never becomes authenticated.
+	'''
+	def __init__(self, request, response, max_age=360, secret='xxx', store=None):
+		self.request = request
+		self.response = response
+		self.max_age = max_age
+		self.serializer = URLSafeTimedSerializer(secret)
+		self.store = store
+		self.modified = False
+		self.issued = None
+		self.sid, self.session = None, {}
+		s = self.request.cookies.get(SESSION_COOKIE_NAME)
+		if s:
+			try:
+				self.sid, self.issued = self.serializer.loads(s, return_timestamp=True)
+			except BadSignature:
+				pass
+			else:
+				data = self.store.get(self.sid)
+				if data is None:
+					self.sid = None
+				else:
+					self.session = data
+
+	def save(self):
+		if not self.modified:
+			if self.sid is not None and self.refresh_due():
+				# extend the store's expiry without writing the data again
+				if hasattr(self.store, 'touch'):
+					self.store.touch(self.sid, self.max_age)
+				else:
+					self.store.set(self.sid, self.session, self.max_age)
+				self.set_cookie()
+			return
+		if not self.session:
+			if self.sid is not None:
+				self.store.delete(self.sid)
+			if SESSION_COOKIE_NAME in self.request.cookies:
+				self.response.delete_cookie(SESSION_COOKIE_NAME)
+			return
+		if self.sid is None:
+			self.sid = binascii.hexlify(os.urandom(16))
+		self.store.set(self.sid, self.session, self.max_age)
+		self.set_cookie()
+
+	def regenerate(self):
+		if self.sid is not None:
+			self.store.delete(self.sid)
+			self.sid = None
+		self.modified = True
+
+	def set_cookie(self):
+		self.response.set_cookie(SESSION_COOKIE_NAME,
+								self.serializer.dumps(self.sid),
+								max_age=self.max_age,
+								httponly=True)
+
+##------------------------------------------------------------------------##
+'''
+Session store API:
+
+def get(self, sid):
+	return dict or None
+
+def set(self, sid, data, max_age):
+	pass
+
+def delete(self, sid):
+	pass
+
+def touch(self, sid, max_age):
+	# optional: extend the expiry only; set() is used otherwise
+	pass
+'''
+class MemorySessionStore(object):
+	''' In-process store; least recently used sessions are evicted first.
+		Each worker of the pre-forking server (twist.server) has its own
+		store, so a client whose requests go to another worker loses its
+		session: use SqliteSessionStore (or another shared store) there.
+	'''
+	def __init__(self, maxsize=10000):
+		self.sessions = LRUCache(maxsize)
+		self.lock = threading.Lock()
+
+	def get(self, sid):
+		with self.lock:
+			entry = self.sessions.get(sid)
+			if entry is None:
+				return None
+			if entry[0] < time.time():
+				del self.sessions[sid]
+				return None
+			return dict(entry[1])
+
+	def set(self, sid, data, max_age):
+		with self.lock:
+			self.sessions[sid] = (time.time() + max_age, dict(data))
+
+	def touch(self, sid, max_age):
+		with self.lock:
+			entry = self.sessions.get(sid)
+			if entry is not None:
+				self.sessions[sid] = (time.time() + max_age, entry[1])
+
+	def delete(self, sid):
+		with self.lock:
+			self.sessions.pop(sid)
+
+class SqliteSessionStore(object):
+	''' Sessions are stored as json; expired rows are purged on writes. '''
+	PURGE_EVERY = 1000
+
+	def __init__(self, dbname):
+		self.con = sqlite3.connect(dbname, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.writes = 0
+		with self.lock, self.con:
+			self.con.execute('create table if not exists twist_session ('
+				'sid text primary key, data text not null, expires real not null)')
+
+	def get(self, sid):
+		with self.lock:
+			row = self.con.execute('select data from twist_session '
+				'where sid=? and expires>=?', (sid, time.time())).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def set(self, sid, data, max_age):
+		now = time.time()
+		with self.lock, self.con:
+			self.con.execute('insert or replace into twist_session '
+				'(sid,data,expires) values (?,?,?)', (sid, json.dumps(data), now+max_age))
+			self.writes += 1
+			if self.writes % self.PURGE_EVERY == 0:
+				self.con.execute('delete from twist_session where expires<?', (now,))
+
+	def touch(self, sid, max_age):
+		with self.lock, self.con:
+			self.con.execute('update twist_session set expires=? where sid=?',
+				(time.time() + max_age, sid))
+
+	def delete(self, sid):
+		with self.lock, self.con:
+			self.con.execute('delete from twist_session where sid=?', (sid,))
+
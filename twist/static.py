@@ -0,0 +1,116 @@
+'''
+Static files served from <working_directory>/static.
+
+	files = StaticFiles.get(view.static_dir())
+	response = files.response(request, 'css/site.css')
+
+Small files are kept in memory (LRU, bounded by total bytes), larger ones
+are streamed through wsgi.file_wrapper (sendfile on most servers).
+Responses carry a strong ETag and Last-Modified and are answered with 304
+when the client's copy is current. A precompressed "name.gz" sibling is
+served instead of "name" to clients that accept gzip.
+'''
+import os
+import stat
+import calendar
+import mimetypes
+from email.utils import formatdate
+from webob import Response
+from webob.static import FileIter, BLOCK_SIZE
+from .cache import LRUCache
+from .compress import Compression
+
+class StaticFiles (object):
+	instances = {}
+
+	def __init__(self, directory, max_age=3600, cache_bytes=16<<20,
+			max_cached_file=256<<10):
+		self.directory = os.path.realpath(directory)
+		self.max_age = max_age
+		self.max_cached_file = max_cached_file
+		# (path, stat signature) -> file content
+		self.cache = LRUCache(cache_bytes, sizeof=lambda v: len(v[1]))
+
+	@classmethod
+	def get(cls, directory):
+		files = cls.instances.get(directory)
+		if files is None:
+			files = cls.instances[directory] = cls(directory)
+		return files
+
+	def resolve(self, fname):
+		try:
+			path = os.path.realpath(os.path.join(self.directory, fname.lstrip('/')))
+		except (TypeError, ValueError):
+			# e.g. a NUL byte in the name
+			return None
+		if not path.startswith(self.directory + os.sep):
+			return None
+		return path
+
+	def stat(self, path):
+		try:
+			st = os.stat(path)
+		except (OSError, TypeError, ValueError):
+			return None
+		return st if stat.S_ISREG(st.st_mode) else None
+
+	def response(self, request, fname):
+		path = self.resolve(fname)
+		st = path and self.stat(path)
+		if not st:
+			# plain text: the name comes from the client
+			return Response(status=404, content_type='text/plain',
+				body='File not found: ' + fname)
+
+		response = Response()
+		content_type = mimetypes.guess_type(path)[0]
+		response.content_type = content_type or 'application/octet-stream'
+		response.cache_control.max_age = self.max_age
+		response.headers['Vary'] = 'Accept-Encoding'
+
+		gz = self.stat(path + '.gz')
+		if gz and gz.st_mtime >= st.st_mtime and Compression.accepts_gzip(request):
+			path, st = path + '.gz', gz
+			response.content_encoding = 'gzip'
+
+		etag = '%x-%x-%x' % (st.st_ino, int(st.st_mtime * 1000000), st.st_size)
+		response.etag = etag
+		response.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+		if self.not_modified(request, etag, st.st_mtime):
+			response.status = 304
+			del response.content_type
+			return response
+
+		if request.method == 'HEAD':
+			response.app_iter = []
+		elif st.st_size <= self.max_cached_file:
+			response.app_iter = [self.read(path, st)]
+		else:
+			f = open(path, 'rb')
+			file_wrapper = request.environ.get('wsgi.file_wrapper')
+			if file_wrapper is not None:
+				response.app_iter = file_wrapper(f, BLOCK_SIZE)
+			else:
+				response.app_iter = FileIter(f)
+		response.content_length = st.st_size
+		return response
+
+	def not_modified(self, request, etag, mtime):
+		if request.if_none_match:
+			return etag in request.if_none_match
+		since = request.if_modified_since
+		if since is not None:
+			return int(mtime) <= calendar.timegm(since.utctimetuple())
+		return False
+
+	def read(self, path, st):
+		key = (path, st.st_ino, st.st_mtime, st.st_size)
+		hit = self.cache.get(path)
+		if hit is not None and hit[0] == key:
+			return hit[1]
+		with open(path, 'rb') as f:
+			body = f.read()
+		self.cache[path] = (key, body)
+		return body
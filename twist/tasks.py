@@ -0,0 +1,153 @@
+'''
+Background tasks, run by a bounded pool of threads once the response has
+been handed to the server:
+	class Signup(View):
+		def post(self, email):
+			...
+			self.defer(send_welcome_mail, email)
+Hooks and other code can queue work directly:
+	Tasks.submit(audit.write, view.request.path)
+
+When the queue is full, submit waits up to Tasks.timeout seconds for room,
+then runs the task on the calling thread: producers slow down, nothing is
+dropped. Pending tasks are drained on teardown.
+	Tasks.workers = 4
+	Tasks.maxsize = 1000
+	Tasks.stats()	# queue depth, counters, wait and run times in seconds
+'''
+import sys
+import time
+import Queue
+import threading
+import traceback
+from .hook import Hook
+
+class Tasks (object):
+	workers = 4
+	maxsize = 1000
+	timeout = 1.0
+	queue = None
+	threads = []
+	hook = None
+	lock = threading.Lock()
+	counters = dict(submitted=0, completed=0, failed=0, inline=0,
+		wait_total=0.0, wait_max=0.0, run_total=0.0, run_max=0.0)
+
+	@classmethod
+	def start(cls):
+		with cls.lock:
+			if cls.queue is not None:
+				return cls.queue
+			if cls.hook is None:
+				cls.hook = TaskHook()
+			queue = Queue.Queue(cls.maxsize)
+			cls.threads = []
+			for i in range(cls.workers):
+				t = threading.Thread(target=cls.work, args=(queue,))
+				t.daemon = True
+				t.start()
+				cls.threads.append(t)
+			cls.queue = queue
+			return queue
+
+	@classmethod
+	def submit(cls, f, *args, **kwargs):
+		queue = cls.queue or cls.start()
+		task = (f, args, kwargs, time.time())
+		with cls.lock:
+			cls.counters['submitted'] += 1
+		try:
+			queue.put(task, timeout=cls.timeout)
+		except Queue.Full:
+			with cls.lock:
+				cls.counters['inline'] += 1
+			cls.run(*task)
+
+	@classmethod
+	def work(cls, queue):
+		while True:
+			task = queue.get()
+			try:
+				if task is None:
+					return
+				cls.run(*task)
+			finally:
+				queue.task_done()
+
+	@classmethod
+	def run(cls, f, args, kwargs, queued):
+		start = time.time()
+		failed = 0
+		try:
+			f(*args, **kwargs)
+		except Exception:
+			failed = 1
+			traceback.print_exc(file=sys.stderr)
+		end = time.time()
+		c = cls.counters
+		with cls.lock:
+			c['completed'] += 1
+			c['failed'] += failed
+			c['wait_total'] += start - queued
+			c['wait_max'] = max(c['wait_max'], start - queued)
+			c['run_total'] += end - start
+			c['run_max'] = max(c['run_max'], end - start)
+
+	@classmethod
+	def stats(cls):
+		with cls.lock:
+			s = dict(cls.counters)
+		s['depth'] = cls.queue.qsize() if cls.queue is not None else 0
+		done = s['completed'] or 1
+		s['wait_avg'] = s['wait_total'] / done
+		s['run_avg'] = s['run_total'] / done
+		return s
+
+	@classmethod
+	def drain(cls):
+		''' Run the pending tasks, then stop the threads. '''
+		with cls.lock:
+			queue, threads = cls.queue, cls.threads
+			cls.queue, cls.threads = None, []
+		if queue is None:
+			return
+		queue.join()
+		for t in threads:
+			queue.put(None)
+		for t in threads:
+			t.join()
+
+	@classmethod
+	def reset(cls):
+		# a forked child has none of the parent's threads, and the lock may
+		# have been held by one of them
+		cls.lock = threading.Lock()
+		cls.queue, cls.threads = None, []
+
+class AfterResponse (object):
+	''' Wraps an app_iter; the deferred tasks are submitted on close(). '''
+	def __init__(self, app_iter, tasks):
+		self.app_iter = app_iter
+		self.tasks = tasks
+
+	def __iter__(self):
+		return iter(self.app_iter)
+
+	def close(self):
+		try:
+			if hasattr(self.app_iter, 'close'):
+				self.app_iter.close()
+		finally:
+			for f, args, kwargs in self.tasks:
+				Tasks.submit(f, *args, **kwargs)
+			self.tasks = []
+
+class TaskHook (Hook):
+	def __init__(self):
+		self.register('Tasks')
+
+	def on_teardown(self):
+		Tasks.drain()
+
+	def on_fork(self):
+		Tasks.reset()
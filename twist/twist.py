@@ -6,27 +6,42 @@ author: Vinhthuy Phan
 import os
 import re
 import sys
-import json
 import types
+import time
+import hashlib
+import inspect
+import threading
 import traceback
-from webob import Request, Response, static
+from webob import Request, Response
 from urllib import urlencode
 from urlparse import parse_qs, urljoin, urlsplit, urlunsplit
 from collections import namedtuple
 from jinja2 import Environment, FileSystemLoader as jj2_loader, TemplateNotFound
-from .session import CookieSession
+from jinja2 import FileSystemBytecodeCache
+from .session import CookieSession, ServerSession
 from .hook import Hook
+from .cache import LRUCache
+from .static import StaticFiles
+from .encoder import Json
+from .model import TypeFactory
+from .upload import UploadRequest, RequestTooLarge
+from .compress import Compression
+from .tasks import Tasks, AfterResponse
 
 Session = CookieSession
 
 ViewConfig = namedtuple('ViewConfig',
-	['working_directory', 'secret', 'session_timeout'])
+	['working_directory', 'secret', 'session_timeout', 'session_store'])
 
 ##------------------------------------------------------------------------##
 class Route (object):
 	table = {'': None}
 	path = {}
 	view = {}
+	compiled = None
+	depth = 0
+	misses = {}		# path -> (obj, args) for paths with positional args
+	maxmisses = 4096
 
 	@classmethod
 	def add(cls, name, obj):
@@ -35,12 +50,49 @@ class Route (object):
 		tokens = cls.split_name(name,[])
 		cls.path[name] = os.path.join(*tokens)
 		cls.add_tokens(tokens, obj, cls.table)
+		cls.compiled = None
+		cls.misses = {}
+
+	@classmethod
+	def compile(cls):
+		''' Flatten Route.table into {'article/update': klass} '''
+		compiled, depth = {}, 0
+		for name, obj in cls.view.items():
+			tokens = cls.split_name(name, [])
+			compiled['/'.join(tokens)] = obj
+			depth = max(depth, len(tokens))
+		cls.compiled, cls.depth = compiled, depth
+		cls.misses = {}
+		return compiled
 
 	@classmethod
 	def lookup(cls, path):
-		''' Route.lookup('/article/update') '''
-		tokens = path.strip('/').split('/')
-		return cls.lookup_tokens(tokens, cls.table)
+		''' Route.lookup('/article/update') -> (klass, args tuple) '''
+		compiled = cls.compiled
+		if compiled is None:
+			compiled = cls.compile()
+		key = path.strip('/')
+		obj = compiled.get(key)
+		if obj is not None:
+			return (obj, ())
+		hit = cls.misses.get(path)
+		if hit is not None:
+			return hit
+		# longest registered prefix wins; the rest are positional args
+		tokens = key.split('/')
+		n = min(len(tokens), cls.depth)
+		prefix = '/'.join(tokens[:n])
+		obj = compiled.get(prefix)
+		while obj is None and n:
+			n -= 1
+			prefix = prefix[:prefix.rfind('/')] if n else ''
+			obj = compiled.get(prefix)
+		hit = (obj, tuple(tokens[n:]))
+		misses = cls.misses
+		if len(misses) >= cls.maxmisses:
+			misses = cls.misses = {}
+		misses[path] = hit
+		return hit
 
 	@classmethod
 	def add_tokens(cls, tokens, obj, table):
@@ -86,6 +138,99 @@ class Route (object):
 		print 'View: ', cls.view
 		print 'Path: ', cls.path
 
+##------------------------------------------------------------------------##
+class ResponseCache (object):
+	''' Rendered GET responses of views that set cache_for (seconds).
+		Keys are built from the view, path, cache_params (all query
+		parameters if None) and the cache_session values of the session.
+	'''
+	entries = LRUCache(1024)
+	keys = {}		# view name -> keys of its cached responses
+	lock = threading.Lock()
+
+	@classmethod
+	def key(cls, view):
+		get = view.request.GET
+		if view.cache_params is None:
+			params = tuple(sorted(get.items()))
+		else:
+			params = tuple((p, tuple(get.getall(p))) for p in view.cache_params)
+		session = tuple(view.session.get(k) for k in view.cache_session)
+		return (view.__class__.__name__, view.request.path_info, params, session)
+
+	@classmethod
+	def get(cls, key):
+		entry = cls.entries.get(key)
+		if entry is not None and entry[0] < time.time():
+			cls.entries.pop(key)
+			return None
+		return entry
+
+	@classmethod
+	def put(cls, key, view):
+		response = view.response
+		headers = [(k, v) for k, v in response.headerlist if k.lower() != 'set-cookie']
+		with cls.lock:
+			cls.entries[key] = (time.time() + view.cache_for, response.status, \
+				headers, response.body, response.etag)
+			keys = cls.keys.setdefault(key[0], set())
+			keys.add(key)
+			if len(keys) > 2 * cls.entries.maxsize:
+				keys.intersection_update(cls.entries.keys())
+
+	@classmethod
+	def invalidate(cls, name):
+		with cls.lock:
+			for key in cls.keys.pop(name, ()):
+				cls.entries.pop(key)
+
+##------------------------------------------------------------------------##
+class Templates (object):
+	''' One jinja2 Environment per working directory, shared by all views.
+		Compiled templates are also kept in an on-disk bytecode cache, so
+		other worker processes and restarts skip the compile step.
+	'''
+	environments = {}
+	auto_reload = True
+	bytecode_dir = None		# None: the system temp directory
+	lock = threading.Lock()
+
+	@classmethod
+	def get(cls, working_directory):
+		env = cls.environments.get(working_directory)
+		if env is None:
+			with cls.lock:
+				env = cls.environments.get(working_directory)
+				if env is None:
+					env = Environment(
+						loader = jj2_loader(os.path.join(working_directory, 'template')),
+						bytecode_cache = FileSystemBytecodeCache(cls.bytecode_dir),
+						auto_reload = cls.auto_reload,
+						cache_size = -1,
+					)
+					cls.environments[working_directory] = env
+		return env
+
+	@classmethod
+	def set_auto_reload(cls, auto_reload):
+		cls.auto_reload = auto_reload
+		for env in cls.environments.values():
+			env.auto_reload = auto_reload
+
+	@classmethod
+	def precompile(cls, working_directory):
+		''' Load every server-side view's template; return the names loaded '''
+		env, loaded = cls.get(working_directory), []
+		for name, view in Route.view.items():
+			if view.client_side_target is None:
+				template = Route.get_template_name(name)
+				try:
+					env.get_template(template)
+				except TemplateNotFound:
+					continue
+				loaded.append(template)
+		return loaded
+
 ##------------------------------------------------------------------------##
 class ViewBuilder(type):
 	def __new__(cls, name, bases, dct):
@@ -95,26 +240,42 @@ class ViewBuilder(type):
 		klass = type.__new__(cls, name, bases, dct)
 		if name!='View':
 			Route.add(name, klass)
+			klass._path_ = Route.path[name]
 			setattr(klass, '_templater_', None)
 		return klass
 
 ##------------------------------------------------------------------------##
 '''
-	Injected class variables: _templater_
+	Injected class variables: _templater_ (raw text of client-side templates)
 '''
 class View (object):
 	__metaclass__ = ViewBuilder
 	_path_ = ''
-	config = ViewConfig(os.getcwd(), 'thebestwaytoservewhiskey', 3600)
+	# request parameters converted by Twist.bind_vars, e.g. {'age': 'int'}
+	param_types = {}
+	# response caching (ResponseCache): ttl in seconds, key parts. A cache
+	# hit skips the handler, and its role checks with it: the session
+	# user (see Auth) is part of the key unless cache_session says otherwise
+	cache_for = None
+	cache_params = None
+	cache_session = ('user',)
+	config = ViewConfig(os.getcwd(), 'thebestwaytoservewhiskey', 3600, None)
 
 	def __init__(self, env):
-		self.request = Request(env)
+		self.request = UploadRequest(env)
 		self.response = Response()
-		self.session = Session(self.request, self.response, \
-			self.config.session_timeout, self.config.secret)
+		self.tasks = []
+		if self.config.session_store is None:
+			self.session = Session(self.request, self.response, \
+				self.config.session_timeout, self.config.secret)
+		else:
+			self.session = ServerSession(self.request, self.response, \
+				self.config.session_timeout, self.config.secret, \
+				self.config.session_store)
 
 	@classmethod
-	def setup(cls, file_name=None, secret=None, session_timeout=None):
+	def setup(cls, file_name=None, secret=None, session_timeout=None,
+			session_store=None):
 		if file_name is None:
 			working_directory = cls.config.working_directory
 		else:
@@ -123,7 +284,10 @@ class View (object):
 			secret = cls.config.secret
 		if session_timeout is None:
 			session_timeout = cls.config.session_timeout
-		cls.config = ViewConfig(working_directory, secret, session_timeout)
+		if session_store is None:
+			session_store = cls.config.session_store
+		cls.config = ViewConfig(working_directory, secret, session_timeout,
+			session_store)
 
 	def template_dir(self):
 		return os.path.join(self.config.working_directory, 'template')
@@ -132,10 +296,13 @@ class View (object):
 		return os.path.join(self.config.working_directory, 'static')
 
 	def static_file(self, fname):
-		file_app = static.FileApp(os.path.join(self.static_dir(),fname))
-		self.response = self.request.get_response(file_app)
+		self.response = StaticFiles.get(self.static_dir()).response(self.request, fname)
 		raise Interrupt()
 
+	def defer(self, f, *args, **kwargs):
+		''' Run f(*args, **kwargs) in the background once the response is sent '''
+		self.tasks.append((f, args, kwargs))
+
 	def error(self, code, message='', interrupt=True):
 	 	self.response.status = code
 	 	self.response.body = message
@@ -161,41 +328,73 @@ class View (object):
 			frag = 'rendered_by_client'
 		return urlunsplit((self.request.scheme,self.request.host,path,qs,frag))
 
+	@classmethod
+	def invalidate(cls, name=None):
+		''' Drop the cached responses of this view, or of the view named name '''
+		ResponseCache.invalidate(Route.view[name].__name__ if name else cls.__name__)
+
 	def redirect(self, view, *args, **kwargs):
 		self.response.location = self.url(view,*args,**kwargs)
 		self.response.status = 303
 		raise Interrupt()
 
-	def render(self, **kw):
-		if self._templater_ is None:
-			template = Route.get_template_name(self.__class__.__name__)
-			try:
-				p = os.path.join(self.config.working_directory, 'template')
-				if self.client_side_target is None:
-					l = Environment(loader=jj2_loader(p))
-					self._templater_ = l.get_template(template)
-				else:
-					self._templater_ = open(os.path.join(p, template)).read()
-			except TemplateNotFound:
-				self.error(500,'template not found: ' + template)
-			except:
-				self.error(500, 'Error processing ' + template)
+	def template(self):
+		''' jinja2 template (server side) or raw template text (client side) '''
+		name = Route.get_template_name(self.__class__.__name__)
+		try:
+			if self.client_side_target is None:
+				return Templates.get(self.config.working_directory).get_template(name)
+			if self._templater_ is None:
+				with open(os.path.join(self.template_dir(), name)) as f:
+					self.__class__._templater_ = f.read()
+			return self._templater_
+		except TemplateNotFound:
+			self.error(500,'template not found: ' + name)
+		except:
+			self.error(500, 'Error processing ' + name)
+
+	def render(self, stream=False, **kw):
+		''' With stream=True, server-side templates are rendered chunk by chunk
+			as the response is sent (jinja2 Template.generate).
+		'''
+		template = self.template()
 		self.response.charset = 'utf8'
 		if self.client_side_target is not None:
 			self.response.content_type = 'application/json'
-			t = dict(template=self._templater_,target=self.client_side_target,data=kw)
-			return json.dumps(t, default=self.serializer)
+			t = dict(template=template,target=self.client_side_target,data=kw)
+			return Json.dumps(t, default=self.serializer)
 		else:
 			self.response.content_type = 'text/html'
 			kw.update(url = self.url)
-			return self._templater_.render(**kw)
+			if stream:
+				return template.generate(**kw)
+			return template.render(**kw)
 
 	def __call__(self, *args, **kwargs):
 		method = getattr(self, self.request.method.lower())
 		o = method(*args, **kwargs)
-		if type(o) not in (str, unicode):
-			self.error(500, 'View must return str or unicode')
-		self.response.text = o if type(o) is unicode else unicode(o)
+		if type(o) in (str, unicode):
+			self.response.text = o if type(o) is unicode else unicode(o)
+		elif hasattr(o, '__iter__') and not isinstance(o, dict):
+			self.response.app_iter = self.encode_chunks(o)
+		else:
+			self.error(500, 'View must return str, unicode or an iterable')
+
+	def encode_chunks(self, chunks):
+		''' Body of a streamed response: chunks are encoded, never joined. '''
+		charset = self.response.charset or 'utf8'
+		try:
+			for chunk in chunks:
+				if type(chunk) is unicode:
+					chunk = chunk.encode(charset)
+				elif type(chunk) is not str:
+					chunk = str(chunk)
+				if chunk:
+					yield chunk
+		finally:
+			# release cursors/files held by the source if the client goes away
+			if hasattr(chunks, 'close'):
+				chunks.close()
 
 	def get(self, *args, **kwargs): self.error(404, 'Unknown handler')
 
@@ -216,32 +415,148 @@ class View (object):
 class Twist (object):
 	log = False
 	mode = 'Testing'
-
-	def __init__(self, file_name=None, secret=None, session_timeout=None):
-		View.setup(file_name, secret, session_timeout)
+	static_prefix = '/static/'
+	signatures = {}
+
+	def __init__(self, file_name=None, secret=None, session_timeout=None,
+			precompile=False, session_store=None):
+		View.setup(file_name, secret, session_timeout, session_store)
+		Route.compile()
+		if precompile:
+			Templates.precompile(View.config.working_directory)
 		Hook._on_setup()
 
 	def __del__(self):
 		Hook._on_teardown()
 
 	def __call__(self, env, start_response):
-		view_cls, args = Route.lookup(env['PATH_INFO'])
+		path = env['PATH_INFO']
+		if self.static_prefix and path.startswith(self.static_prefix):
+			return self.serve_static(env, start_response, path)
+		view_cls, args = Route.lookup(path)
 		view = view_cls(env)
-		kwargs = self.extract_vars(view.request.params)
+		cache_key = None
+		if view.cache_for and view.request.method == 'GET':
+			cache_key = ResponseCache.key(view)
+			entry = ResponseCache.get(cache_key)
+			if entry is not None:
+				return self.send_cached(view, entry, start_response)
 		try:
-			Hook._before_execute_view(view)
+			kwargs = self.bind_vars(view, args)
+			if Hook._before_execute_view:
+				Hook._before_execute_view(view)
 			view(*args, **kwargs)
-			Hook._after_execute_view(view)
+			if Hook._after_execute_view:
+				Hook._after_execute_view(view)
 			view.session.save()
 		except Interrupt:
 			view.session.save()
+		except RequestTooLarge as e:
+			view.error(413, str(e), interrupt=False)
+		except ServiceUnavailable as e:
+			view.error(503, str(e), interrupt=False)
+			view.response.retry_after = 1
+			view.tasks = []
 		except:
 			if Twist.mode == 'Testing': mesg = traceback.format_exc()
 			else: mesg = HTTP_CODE[400]
 			view.error(400, mesg, interrupt=False)
-
+			view.tasks = []
+		finally:
+			if Hook._on_request_end:
+				Hook._on_request_end()
+
+		if cache_key is not None and view.response.status_int == 200 and \
+				isinstance(view.response.app_iter, list):
+			view.response.etag = hashlib.md5(view.response.body).hexdigest()
+			if 'Set-Cookie' not in view.response.headers:
+				ResponseCache.put(cache_key, view)
+			etag = view.response.etag
+			if self.not_modified(view.request, etag):
+				view.response.status = 304
+				view.response.body = ''
+				if etag not in view.request.if_none_match:
+					# the client holds the gzip variant, as in send_cached
+					view.response.etag = etag + '-gz'
+		Compression.apply(view.request, view.response)
 		start_response(view.response.status, view.response.headers.items())
-		return [view.response.body]
+		if view.tasks:
+			return AfterResponse(view.response.app_iter, view.tasks)
+		return view.response.app_iter
+
+	def send_cached(self, view, entry, start_response):
+		expires, status, headers, body, etag = entry
+		if self.not_modified(view.request, etag):
+			if etag not in view.request.if_none_match:
+				etag += '-gz'
+			start_response('304 Not Modified', [('ETag', '"%s"' % etag)])
+			return []
+		response = Response(status=status, headerlist=list(headers), body=body)
+		Compression.apply(view.request, response)
+		start_response(response.status, response.headerlist)
+		return response.app_iter
+
+	def not_modified(self, request, etag):
+		# the gzip variant of a response has its own etag
+		return etag in request.if_none_match or \
+			etag + '-gz' in request.if_none_match
+
+	def serve_static(self, env, start_response, path):
+		files = StaticFiles.get(os.path.join(View.config.working_directory,'static'))
+		response = files.response(Request(env), path[len(self.static_prefix):])
+		start_response(response.status, response.headerlist)
+		return response.app_iter
+
+	def signature(self, view):
+		'''
+		(names, converters) of the parameters a handler declares, or None
+		if it takes **kwargs (or is wrapped, e.g. by Auth.requires_role).
+		'''
+		method = getattr(view, view.request.method.lower(), None)
+		try:
+			spec = inspect.getargspec(method)
+		except TypeError:
+			return None
+		if spec.keywords is not None:
+			return None
+		names = spec.args[1:]
+		types = view.param_types
+		converters = [TypeFactory.get(types[n]) if n in types else None \
+			for n in names]
+		return names, converters
+
+	def bind_vars(self, view, args):
+		''' Extract only the parameters the handler declares; the request
+			body is not parsed unless one of them is missing from the URL.
+		'''
+		key = (view.__class__, view.request.method)
+		try:
+			spec = self.signatures[key]
+		except KeyError:
+			spec = self.signatures[key] = self.signature(view)
+		if spec is None:
+			return self.extract_vars(view.request.params)
+		# positional url tokens fill the first parameters
+		names, converters = spec[0][len(args):], spec[1][len(args):]
+		if not names:
+			return {}
+		request, d = view.request, {}
+		for i, n in enumerate(names):
+			if n in request.GET:
+				form = request.GET
+			elif request.method in ('POST', 'PUT') and n in request.POST:
+				form = request.POST
+			else:
+				continue
+			value = form.getall(n)
+			value = value[0] if len(value) == 1 else value
+			if converters[i] is not None:
+				try:
+					value = converters[i].value(value)
+				except (TypeError, ValueError) as e:
+					view.error(400, 'Invalid parameter %s: %s' % (n, e))
+			d[n] = value
+		return d
 
 	def extract_vars(self, form):
 		d = {}
@@ -254,12 +569,30 @@ class Twist (object):
 
 	#----------------------------------------------------------------------
 	@classmethod
-	def setup(cls, log=False, mode='Testing'):
+	def setup(cls, log=False, mode='Testing', static_prefix='/static/',
+			max_request_size=None, max_part_size=None):
+		''' static_prefix=None leaves static files to the views.
+			Multipart bodies and parts over max_*_size bytes get a 413.
+		'''
 		assert mode in ('Production', 'Testing')
 		cls.log = log
 		cls.mode = mode
-
-	def run(self, host='127.0.0.1', port=8000):
+		cls.static_prefix = static_prefix
+		UploadRequest.max_request_size = max_request_size
+		UploadRequest.max_part_size = max_part_size
+		Templates.set_auto_reload(mode != 'Production')
+
+	def run(self, host='127.0.0.1', port=8000, workers=0, threads=1, max_requests=0):
+		''' Development server by default. With workers or threads, the
+			pre-forking server of twist.server: the app and its templates
+			are loaded once here, before the workers are forked.
+		'''
+		if workers or threads > 1:
+			from .server import serve
+			Route.compile()
+			Templates.precompile(View.config.working_directory)
+			serve(self, host, port, workers or 1, threads, max_requests)
+			return
 		from wsgiref.simple_server import make_server
 		print 'serving on port', port
 		try:
@@ -274,13 +607,19 @@ class Twist (object):
 class Interrupt (Exception):
 	pass
 
+class ServiceUnavailable (Exception):
+	''' Raised when a resource is saturated; answered with 503 '''
+	pass
+
 ##------------------------------------------------------------------------##
 HTTP_CODE = {
 	400 : '400 Bad Request',
 	401 : '401 Unauthorized',
 	404 : '404 Not Found',
 	405 : '405 Method Not Allowed',
+	413 : '413 Request Entity Too Large',
 	500 : '500 Interal Server Error',
+	503 : '503 Service Unavailable',
 }
 
 
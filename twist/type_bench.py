@@ -0,0 +1,45 @@
+'''
+Type conversion benchmark, fast parsers against the strptime path:
+	python -m twist.type_bench [values]
+'''
+import sys
+import time
+import datetime
+from .model import DateType, DatetimeType, TimeType, IntType
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+def strptime_date(v):
+	(y, m, d, hh, mm, ss, t0, t1, t2) = time.strptime(v,'%Y-%m-%d')
+	return datetime.date(y, m, d)
+
+def strptime_datetime(v):
+	(y, m, d, hh, mm, ss, t0, t1, t2) = time.strptime(v,'%Y-%m-%d %H:%M:%S')
+	return datetime.datetime(y, m, d, hh, mm, ss)
+
+def regex_time(v):
+	value = TimeType.REGEX_TIME.match(v.lower())
+	return datetime.time(int(value.group('h')), int(value.group('m')), int(value.group('s')))
+
+def timed(label, f, values):
+	start = time.time()
+	f(values)
+	elapsed = time.time() - start
+	print '%-28s %7.3fs  %6.2f us/value' % (label, elapsed, elapsed / N * 1e6)
+
+dates = ['20%02d-%02d-%02d' % (i % 100, 1 + i % 12, 1 + i % 28) for i in range(N)]
+datetimes = [d + ' %02d:%02d:%02d' % (i % 24, i % 60, i % 60) for i, d in enumerate(dates)]
+times = [v[11:] for v in datetimes]
+natives = [datetime.date(2014, 1, 1 + i % 28) for i in range(N)]
+
+print '%d values' % N
+timed('date strptime', lambda vs: [strptime_date(v) for v in vs], dates)
+timed('date value', lambda vs: map(DateType().value, vs), dates)
+timed('date convert_many', DateType().convert_many, dates)
+timed('datetime strptime', lambda vs: [strptime_datetime(v) for v in vs], datetimes)
+timed('datetime value', lambda vs: map(DatetimeType().value, vs), datetimes)
+timed('datetime convert_many', DatetimeType().convert_many, datetimes)
+timed('time regex', lambda vs: [regex_time(v) for v in vs], times)
+timed('time convert_many', TimeType().convert_many, times)
+timed('native date convert_many', DateType().convert_many, natives)
+timed('native int convert_many', IntType().convert_many, range(N))
@@ -0,0 +1,194 @@
+'''
+Request body limits and streaming multipart/form-data parsing.
+
+The body is read from wsgi.input in chunks; file parts spill to a
+temporary file once they grow past memory_limit bytes. Bodies or parts
+over the configured limits raise RequestTooLarge (answered with 413)
+as soon as the limit is crossed:
+	Twist.setup(max_request_size=100<<20, max_part_size=20<<20)
+max_request_size covers every body: urlencoded forms, JSON and any other
+body read through request.body or request.POST are checked before they
+are buffered.
+In a view, uploads look like cgi.FieldStorage items:
+	f = self.request.POST['photo']
+	f.filename, f.type, f.size, f.file.read()
+'''
+import cgi
+import tempfile
+from webob import Request
+from webob.multidict import MultiDict
+
+class RequestTooLarge (Exception):
+	pass
+
+class UploadedFile (object):
+	def __init__(self, name, filename, type, file, size):
+		self.name = name
+		self.filename = filename
+		self.type = type
+		self.file = file
+		self.size = size
+
+	def read(self, *args):
+		return self.file.read(*args)
+
+	def __repr__(self):
+		return '<UploadedFile %s: %s (%d bytes)>' % (self.name, self.filename, self.size)
+
+class UploadRequest (Request):
+	max_request_size = None		# bytes; None: no limit
+	max_part_size = None
+	memory_limit = 1 << 20
+	chunk_size = 64 << 10
+
+	@property
+	def POST(self):
+		env = self.environ
+		if self.content_type == 'multipart/form-data' and \
+				'webob._parsed_post_vars' not in env:
+			env['webob._parsed_post_vars'] = (self.parse_multipart(), self.body_file_raw)
+		return super(UploadRequest, self).POST
+
+	def check_size(self, length):
+		if self.max_request_size is not None and length > self.max_request_size:
+			raise RequestTooLarge('Request body exceeds %d bytes' % self.max_request_size)
+
+	def make_body_seekable(self):
+		# webob buffers the whole body here, for .body, .POST and .json
+		if self.content_length is not None:
+			self.check_size(self.content_length)
+		elif self.max_request_size is not None and not self.is_body_seekable \
+				and self.is_body_readable:
+			# chunked: read no more than one byte past the limit
+			data = self.body_file_raw.read(self.max_request_size + 1)
+			self.check_size(len(data))
+			self.body = data
+		super(UploadRequest, self).make_body_seekable()
+
+	def parse_multipart(self):
+		length = self.content_length
+		if length is not None:
+			self.check_size(length)
+		elif not self.is_body_readable:
+			length = 0
+		boundary = cgi.parse_header(self.environ.get('CONTENT_TYPE', ''))[1].get('boundary')
+		if not boundary:
+			raise ValueError('multipart/form-data without boundary')
+		parser = MultipartParser(boundary, self.max_part_size, self.memory_limit)
+		# without a length (chunked), read to the end, checking the total
+		stream, total = self.body_file_raw, 0
+		while length is None or total < length:
+			size = self.chunk_size if length is None else min(self.chunk_size, length - total)
+			chunk = stream.read(size)
+			if not chunk:
+				break
+			total += len(chunk)
+			if length is None:
+				self.check_size(total)
+			parser.feed(chunk)
+		return parser.close()
+
+##------------------------------------------------------------------------##
+class MultipartParser (object):
+	''' Incremental parser; feed() body chunks, close() returns a MultiDict. '''
+	MAX_HEADER = 16 << 10
+
+	def __init__(self, boundary, max_part_size=None, memory_limit=1<<20):
+		self.delimiter = '\r\n--' + boundary
+		self.max_part_size = max_part_size
+		self.memory_limit = memory_limit
+		# the first delimiter has no leading CRLF
+		self.buffer = '\r\n'
+		self.state = 'preamble'
+		self.vars = MultiDict()
+		self.part = None
+
+	def feed(self, data):
+		self.buffer += data
+		while self.step():
+			pass
+
+	def step(self):
+		''' Consume as much of the buffer as possible; True to go on. '''
+		if self.state == 'preamble':
+			i = self.buffer.find(self.delimiter)
+			if i < 0:
+				self.buffer = self.buffer[-len(self.delimiter):]
+				return False
+			self.buffer = self.buffer[i + len(self.delimiter):]
+			self.state = 'delimiter'
+			return True
+		if self.state == 'delimiter':
+			if len(self.buffer) < 2:
+				return False
+			if self.buffer.startswith('--'):
+				self.state, self.buffer = 'done', ''
+				return False
+			self.buffer = self.buffer[2:]
+			self.state = 'headers'
+			return True
+		if self.state == 'headers':
+			i = self.buffer.find('\r\n\r\n')
+			if i < 0:
+				if len(self.buffer) > self.MAX_HEADER:
+					raise RequestTooLarge('Multipart headers too large')
+				return False
+			self.start_part(self.buffer[:i])
+			self.buffer = self.buffer[i+4:]
+			self.state = 'body'
+			return True
+		if self.state == 'body':
+			i = self.buffer.find(self.delimiter)
+			if i < 0:
+				# keep a tail that may hold the start of the delimiter
+				keep = len(self.delimiter) - 1
+				if len(self.buffer) > keep:
+					self.write(self.buffer[:-keep])
+					self.buffer = self.buffer[-keep:]
+				return False
+			self.write(self.buffer[:i])
+			self.end_part()
+			self.buffer = self.buffer[i + len(self.delimiter):]
+			self.state = 'delimiter'
+			return True
+		return False
+
+	def start_part(self, raw):
+		headers = {}
+		for line in raw.split('\r\n'):
+			if ':' in line:
+				key, value = line.split(':', 1)
+				headers[key.strip().lower()] = value.strip()
+		disposition, params = cgi.parse_header(headers.get('content-disposition', ''))
+		name, filename = params.get('name'), params.get('filename')
+		if filename is not None:
+			f = tempfile.SpooledTemporaryFile(max_size=self.memory_limit)
+		else:
+			f = tempfile.SpooledTemporaryFile(max_size=self.MAX_HEADER)
+		content_type = headers.get('content-type', 'text/plain')
+		self.part = [name, filename, content_type, f, 0]
+
+	def write(self, data):
+		if not data:
+			return
+		self.part[4] += len(data)
+		if self.max_part_size is not None and self.part[4] > self.max_part_size:
+			raise RequestTooLarge('Part "%s" exceeds %d bytes' % \
+				(self.part[0], self.max_part_size))
+		self.part[3].write(data)
+
+	def end_part(self):
+		name, filename, content_type, f, size = self.part
+		f.seek(0)
+		if filename is None:
+			value = f.read().decode('utf8', 'replace')
+			f.close()
+		else:
+			value = UploadedFile(name, filename, content_type, f, size)
+		self.vars.add(name.decode('utf8', 'replace') if name else name, value)
+		self.part = None
+
+	def close(self):
+		if self.state != 'done':
+			raise ValueError('Incomplete multipart body')
+		return self.vars
@@ -0,0 +1,90 @@
+'''
+Multipart parser and request body limits:
+	python -m twist.upload_test
+'''
+from StringIO import StringIO
+from .upload import UploadRequest, MultipartParser, RequestTooLarge
+
+BOUNDARY = 'xYzZY'
+body = '\r\n'.join([
+	'--' + BOUNDARY,
+	'Content-Disposition: form-data; name="title"',
+	'',
+	'hello\r\n--not-a-boundary',
+	'--' + BOUNDARY,
+	'Content-Disposition: form-data; name="photo"; filename="a.bin"',
+	'Content-Type: application/octet-stream',
+	'',
+	''.join(chr(i % 256) for i in range(5000)) + '\r\n--' + BOUNDARY[:3],
+	'--' + BOUNDARY + '--',
+	'',
+])
+
+def parse(data, chunk, **kw):
+	parser = MultipartParser(BOUNDARY, **kw)
+	for i in range(0, len(data), chunk):
+		parser.feed(data[i:i+chunk])
+	return parser.close()
+
+# every split of the body, down to one byte at a time
+expected = None
+for chunk in (1, 2, 3, 7, 64, 4096, len(body)):
+	vars = parse(body, chunk, memory_limit=1024)
+	got = (vars['title'], vars['photo'].filename, vars['photo'].size, vars['photo'].read())
+	assert expected is None or got == expected, chunk
+	expected = got
+assert expected[0] == u'hello\r\n--not-a-boundary'
+assert expected[2] == 5000 + len('\r\n--' + BOUNDARY[:3])
+
+# a truncated body is an error, wherever it stops
+for end in (10, body.index('filename'), len(body) - 10):
+	try:
+		parse(body[:end], 100)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('truncated at %d' % end)
+
+# part limit
+try:
+	parse(body, 100, max_part_size=1000)
+except RequestTooLarge:
+	pass
+else:
+	raise AssertionError('max_part_size')
+
+def request(data, content_type, length=True):
+	env = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type,
+		'wsgi.input': StringIO(data)}
+	if length:
+		env['CONTENT_LENGTH'] = str(len(data))
+	else:
+		env['wsgi.input_terminated'] = True
+	return UploadRequest(env)
+
+def too_large(f):
+	try:
+		f()
+	except RequestTooLarge:
+		return True
+	return False
+
+form = 'a=' + 'x' * 1000
+multipart = 'multipart/form-data; boundary=' + BOUNDARY
+UploadRequest.max_request_size = 100
+try:
+	assert too_large(lambda: request(body, multipart).POST)
+	assert too_large(lambda: request(body, multipart, False).POST)
+	assert too_large(lambda: request(form, 'application/x-www-form-urlencoded').POST)
+	assert too_large(lambda: request(form, 'application/x-www-form-urlencoded', False).POST)
+	assert too_large(lambda: request(form, 'application/json').body)
+	assert request('a=1', 'application/x-www-form-urlencoded').POST['a'] == u'1'
+	assert request('a=1', 'application/x-www-form-urlencoded', False).POST['a'] == u'1'
+finally:
+	UploadRequest.max_request_size = None
+assert request(body, multipart).POST['title'] == expected[0]
+# chunked multipart: no Content-Length, read to the end of the input
+chunked = request(body, multipart, False).POST
+assert chunked['title'] == expected[0] and chunked['photo'].read() == expected[3]
+assert len(request(form, 'application/x-www-form-urlencoded').POST['a']) == 1000
+print 'upload: ok'
@@ -18,6 +18,10 @@ class Validator(object):
 				self.error = '%s(%s) = false' % (self.name, str(a))
 		return result
 
+	# SQL text of "a op b"; a and b are column names or placeholders
+	def sql(self, a, b=None):
+		return '%s %s %s' % (a, self.sql_rep, b)
+
 class combine_validators(Validator):
 	def __init__(self, validators):
 		self.validators = validators
@@ -102,6 +106,9 @@ class is_both(Validator):
 	def __call__(self,a,b):
 		return super(is_both, self).eval(a and b, a, b)
 
+	def sql(self, a, b):
+		return '(%s AND %s)' % (a, b)
+
 class is_either(Validator):
 	def __init__(self):
 		super(is_either, self).__init__('is_either', 'OR', None)
@@ -109,6 +116,9 @@ class is_either(Validator):
 	def __call__(self,a,b):
 		return super(is_either, self).eval(a or b, a, b)
 
+	def sql(self, a, b):
+		return '(%s OR %s)' % (a, b)
+
 class is_not(Validator):
 	def __init__(self):
 		super(is_not, self).__init__('is_not', 'NOT', None)
@@ -116,6 +126,9 @@ class is_not(Validator):
 	def __call__(self,a):
 		return super(is_not, self).eval(not a, a, None)
 
+	def sql(self, a):
+		return 'NOT (%s)' % a
+
 class is_between(Validator):
 	def __init__(self, m, n):
 		self.m = m
@@ -152,12 +165,17 @@ class is_in(Validator):
 		self.things = things
 		super(is_in, self).__init__('is_in', None, None)
 
-	def __call__(self, value):
-		result = value in self.things
+	def __call__(self, value, things=None):
+		things = things if things is not None else self.things
+		result = value in things
 		if not result:
-			self.error = 'is_in(%s)(%s) = false' % (str(self.things), str(value))
+			self.error = 'is_in(%s)(%s) = false' % (str(things), str(value))
 		return result
 
+	# the whole list is bound as one array parameter
+	def sql(self, a, b):
+		return '%s = ANY(%s)' % (a, b)
+
 class is_month(is_in):
 	def __init__(self):
 		super(is_month, self).__init__( \